@@ -0,0 +1,110 @@
+"""Benchmark sync against local fake Cloudbeds and Seam APIs.
+
+    python -m bench                  # run every scenario, compare to baseline.json
+    python -m bench small            # just the named scenarios
+    python -m bench --update         # record the results as the new baseline
+
+Each scenario runs in its own process and scratch directory: a cold full
+sync, a warm full sync with nothing changed, an incremental sync after
+some reservations change, then common lock sync on its own. Exits 1 if
+any step makes more upstream calls or DB statements than the baseline
+allows, or runs much slower.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(REPO, "bench", "baseline.json")
+
+# latency: seconds added to every fake API call; seam_rate: Seam requests/second per key;
+# modified: fraction of reservations changed before the incremental step
+SCENARIOS = {
+    "small": dict(reservations=50, rooms_per_reservation=1, room_locks=20, common_locks=2),
+    "multi_room": dict(reservations=300, rooms_per_reservation=2, room_locks=100, common_locks=3, latency=0.01),
+    "rate_limited": dict(reservations=100, rooms_per_reservation=1, room_locks=40, common_locks=2,
+                         latency=0.02, seam_rate=50),
+}
+
+# Calls and statements are deterministic for a dataset, so allow little slack;
+# wall time varies between machines and runs, so flag only large slowdowns
+COUNT_TOLERANCE = 0.05
+TIME_TOLERANCE = 0.5
+TIME_SLACK = 0.25  # seconds
+
+
+def run_scenario(name):
+    work = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    try:
+        # ota reads its config from the working directory at import
+        shutil.copy(os.path.join(REPO, "ota_config.json"), work)
+        env = {**os.environ, "PYTHONPATH": REPO}
+        proc = subprocess.run(
+            [sys.executable, "-m", "bench.scenario", json.dumps(SCENARIOS[name])],
+            cwd=work, env=env, capture_output=True, text=True,
+        )
+        if proc.returncode:
+            sys.exit(f"Scenario {name} failed:\n{proc.stderr}")
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def regressions(result, base):
+    """Names of the measures in `result` that are worse than `base` allows."""
+    worse = []
+    for measure in ("calls", "statements"):
+        if result[measure] > base[measure] * (1 + COUNT_TOLERANCE):
+            worse.append(measure)
+    if result["seconds"] > base["seconds"] * (1 + TIME_TOLERANCE) + TIME_SLACK:
+        worse.append("seconds")
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark reservation and common lock sync.")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"one of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--update", action="store_true", help="record these results as the baseline")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(sorted(unknown))}")
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    results = {}
+    failed = []
+    for name in args.scenarios or SCENARIOS:
+        results[name] = run_scenario(name)
+        print(f"\n{name}: {SCENARIOS[name]}")
+        print(f"  {'step':<12} {'seconds':>8} {'calls':>6} {'stmts':>6}   baseline")
+        for step, r in results[name].items():
+            base = baseline.get(name, {}).get(step)
+            worse = regressions(r, base) if base and not args.update else []
+            against = f"{base['seconds']:>8} {base['calls']:>6} {base['statements']:>6}" if base else "       -"
+            flag = f"  REGRESSED: {', '.join(worse)}" if worse else ""
+            print(f"  {step:<12} {r['seconds']:>8} {r['calls']:>6} {r['statements']:>6}   {against}{flag}")
+            print(f"  {'':<12} {', '.join(f'{k}={v}' for k, v in r['by_endpoint'].items()) or 'no upstream calls'}")
+            if worse:
+                failed.append(f"{name}/{step}")
+
+    if args.update:
+        baseline.update(results)
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+        print(f"\nBaseline written to {BASELINE}")
+    elif failed:
+        sys.exit(f"\nRegressed against baseline: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
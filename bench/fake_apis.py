@@ -0,0 +1,193 @@
+"""Local stand-ins for the Cloudbeds and Seam endpoints sync uses.
+
+One Flask app serves both, under /cloudbeds and /seam, from a
+background thread. Every request can be delayed by a fixed latency, and
+each API key is rate limited with 429s the way the real APIs do.
+"""
+import itertools
+import logging
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+
+
+class RateLimit:
+    """Token bucket; take() returns 0 or the seconds until a token is free."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class FakeUpstream:
+    """Cloudbeds reservations and Seam access codes held in memory.
+
+    `latency` is seconds added to every call. `seam_rate` and
+    `cloudbeds_rate` are requests per second allowed per API key (None
+    for unlimited), with bursts of the same size.
+    """
+
+    def __init__(self, latency=0.0, seam_rate=None, cloudbeds_rate=None):
+        self.latency = latency
+        self.rates = {"seam": seam_rate, "cloudbeds": cloudbeds_rate}
+        self.limits = {}
+        self.reservations = {}
+        self.codes = defaultdict(dict)  # device_id -> access_code_id -> code
+        self.calls = Counter()          # "api endpoint" -> requests, 429s included
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.server = None
+
+    def generate(self, reservations, rooms_per_reservation, room_ids):
+        """Synthetic reservations spread over the sync window.
+
+        Each reservation books `rooms_per_reservation` of `room_ids`,
+        round-robin; most check out in the future so they need codes.
+        """
+        today = date.today()
+        for i in range(reservations):
+            rid = str(800000000 + i)
+            check_in = today + timedelta(days=i % 12 - 5)
+            check_out = check_in + timedelta(days=3)
+            rooms = [room_ids[(i * rooms_per_reservation + j) % len(room_ids)] for j in range(rooms_per_reservation)]
+            self.reservations[rid] = {
+                "reservationID": rid,
+                "guestName": f"Guest {i}",
+                "status": "confirmed",
+                "reservationCheckIn": check_in.isoformat(),
+                "reservationCheckOut": check_out.isoformat(),
+                "balance": 0.0,
+                "dateModified": "2026-01-01 00:00:00",
+                "rooms": [{
+                    "roomID": room_id,
+                    "roomTypeID": "1",
+                    "roomName": f"Room {room_id}",
+                    "roomStatus": "not_checked_in",
+                    "roomCheckIn": check_in.isoformat(),
+                    "roomCheckOut": check_out.isoformat(),
+                } for room_id in dict.fromkeys(rooms)],
+            }
+
+    def modify(self, fraction, modified_at="2026-06-01 00:00:00"):
+        """Push a fraction of reservations' check-out back a day, as guests extending would."""
+        step = max(1, round(1 / fraction)) if fraction else 0
+        changed = list(self.reservations.values())[::step] if step else []
+        for res in changed:
+            check_out = (date.fromisoformat(res["reservationCheckOut"]) + timedelta(days=1)).isoformat()
+            res["reservationCheckOut"] = check_out
+            res["dateModified"] = modified_at
+            for room in res["rooms"]:
+                room["roomCheckOut"] = check_out
+        return len(changed)
+
+    def app(self):
+        app = Flask("fake_upstream")
+
+        @app.before_request
+        def _throttle():
+            api, _, endpoint = request.path.strip("/").partition("/")
+            with self.lock:
+                self.calls[f"{api} {endpoint}"] += 1
+            if self.latency:
+                time.sleep(self.latency)
+            rate = self.rates.get(api)
+            if rate:
+                key = (api, request.headers.get("Authorization"))
+                with self.lock:
+                    limit = self.limits.setdefault(key, RateLimit(rate, rate))
+                wait = limit.take()
+                if wait:
+                    return jsonify({"error": "rate limited"}), 429, {"Retry-After": str(math.ceil(wait))}
+
+        @app.get("/cloudbeds/getReservations")
+        def get_reservations():
+            args = request.args
+            rows = [
+                r for r in self.reservations.values()
+                if args.get("checkInFrom", "") <= r["reservationCheckIn"] <= args.get("checkInTo", "9999")
+                and r["dateModified"] >= args.get("modifiedFrom", "")
+            ]
+            page, size = int(args.get("pageNumber", 1)), int(args.get("pageSize", 100))
+            data = [{"reservationID": r["reservationID"]} for r in rows[(page - 1) * size:page * size]]
+            return jsonify({"success": True, "data": data, "total": len(rows)})
+
+        @app.get("/cloudbeds/getReservationsWithRateDetails")
+        def get_details():
+            ids = request.args.get("reservationID", "").split(",")
+            return jsonify({"success": True, "data": [self.reservations[i] for i in ids if i in self.reservations]})
+
+        @app.post("/seam/access_codes/list")
+        def list_codes():
+            with self.lock:
+                codes = list(self.codes[request.json["device_id"]].values())
+            return jsonify({"access_codes": codes})
+
+        @app.post("/seam/access_codes/create")
+        def create_code():
+            body = request.json
+            code = {
+                "access_code_id": f"ac_{next(self._ids)}",
+                "device_id": body["device_id"],
+                "code": body["code"],
+                "name": body.get("name"),
+                "starts_at": body.get("starts_at"),
+                "ends_at": body.get("ends_at"),
+            }
+            with self.lock:
+                self.codes[body["device_id"]][code["access_code_id"]] = code
+            return jsonify({"access_code": code})
+
+        @app.post("/seam/access_codes/get")
+        def get_code():
+            with self.lock:
+                for codes in self.codes.values():
+                    if request.json["access_code_id"] in codes:
+                        return jsonify({"access_code": codes[request.json["access_code_id"]]})
+            return jsonify({"error": {"type": "access_code_not_found"}}), 404
+
+        @app.post("/seam/access_codes/update")
+        def update_code():
+            body = request.json
+            with self.lock:
+                for codes in self.codes.values():
+                    if body["access_code_id"] in codes:
+                        codes[body["access_code_id"]].update(starts_at=body.get("starts_at"), ends_at=body.get("ends_at"))
+                        return jsonify({"ok": True})
+            return jsonify({"error": {"type": "access_code_not_found"}}), 404
+
+        @app.post("/seam/access_codes/delete")
+        def delete_code():
+            with self.lock:
+                for codes in self.codes.values():
+                    codes.pop(request.json["access_code_id"], None)
+            return jsonify({"ok": True})
+
+        return app
+
+    def start(self):
+        """Serve on a free local port; returns the base URL."""
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.server = make_server("127.0.0.1", 0, self.app(), threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
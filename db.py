@@ -1,8 +1,68 @@
-from peewee import SqliteDatabase, Model, AutoField, TextField, FloatField, DateTimeField
-from playhouse.sqlite_ext import JSONField
+import json
+import threading
+import zlib
+from peewee import (
+    SqliteDatabase, Model, AutoField, IntegerField, TextField, FloatField, DateTimeField, BlobField, chunked,
+)
 from datetime import datetime, timezone
 
-db = SqliteDatabase("hotel-automation.db")
+class CountingDatabase(SqliteDatabase):
+    """SqliteDatabase that counts the queries each thread issues, for metrics."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._queries = threading.local()
+
+    def execute_sql(self, sql, params=None):
+        self._queries.count = getattr(self._queries, "count", 0) + 1
+        return super().execute_sql(sql, params)
+
+    def query_count(self):
+        return getattr(self._queries, "count", 0)
+
+
+# WAL lets guest/OTA reads proceed while sync writes; writers wait up to
+# busy_timeout for each other instead of failing with "database is locked".
+db = CountingDatabase("hotel-automation.db", pragmas={
+    "journal_mode": "wal",
+    "busy_timeout": 5000,
+    "synchronous": "normal",
+    "mmap_size": 64 * 1024 * 1024,
+    "cache_size": -16 * 1024,  # KiB
+})
+
+# Rows per write transaction in write_batches()
+WRITE_BATCH_SIZE = 200
+# Ids per DELETE ... WHERE id IN (...), well under SQLite's 999 variables
+ID_BATCH_SIZE = 500
+
+
+def query_count():
+    """Queries issued so far by the calling thread."""
+    return db.query_count()
+
+
+def init_app(app):
+    """Open a connection per request and close it when the request ends."""
+    @app.before_request
+    def _db_connect():
+        db.connect(reuse_if_open=True)
+
+    @app.teardown_request
+    def _db_close(exc):
+        if not db.is_closed():
+            db.close()
+
+
+def write_batches(rows, size=WRITE_BATCH_SIZE):
+    """Yield `rows` in chunks, each inside its own short transaction.
+
+    For bulk writes from sync: readers and other writers get the database
+    between chunks instead of waiting out one long transaction.
+    """
+    for batch in chunked(rows, size):
+        with db.atomic():
+            yield batch
 
 
 class BaseModel(Model):
@@ -24,8 +84,27 @@ class RoomStay(BaseModel):
     res_status = TextField()
     balance = FloatField()
     date_modified = TextField()
-    data = JSONField()
     seam_access_code_id = TextField(null=True)
+    seam_window = TextField(null=True)  # "starts_at|ends_at" last pushed to Seam
+
+
+class ReservationPayload(BaseModel):
+    """Raw Cloudbeds reservation payload, stored once per reservation.
+
+    Kept zlib-compressed and only decoded when `.payload` is read; sync
+    rewrites it when the reservation's dateModified changes.
+    """
+    reservation_id = TextField(primary_key=True)
+    date_modified = TextField()
+    blob = BlobField()
+
+    @staticmethod
+    def encode(payload):
+        return zlib.compress(json.dumps(payload, separators=(",", ":")).encode())
+
+    @property
+    def payload(self):
+        return json.loads(zlib.decompress(self.blob))
 
 
 class ChatMessage(BaseModel):
@@ -34,3 +113,30 @@ class ChatMessage(BaseModel):
     sender = TextField()
     message = TextField()
     created_at = DateTimeField(default=lambda: datetime.now(timezone.utc))
+
+
+class ChatMessageArchive(BaseModel):
+    """Conversations moved out of ChatMessage once the guest is long gone.
+
+    Keeps the original message ids, so history cursors carry across tiers.
+    """
+    id = IntegerField(primary_key=True)
+    reservation_id = TextField()
+    sender = TextField()
+    message = TextField()
+    created_at = DateTimeField()
+
+
+class ConversationSummary(BaseModel):
+    """One row per live conversation, kept current on every message insert.
+
+    Feeds the staff sidebar. unread_count counts guest messages since
+    staff last replied or opened the conversation.
+    """
+    reservation_id = TextField(primary_key=True)
+    guest_name = TextField(null=True)
+    last_message_id = IntegerField()
+    last_message = TextField()
+    last_sender = TextField()
+    last_activity = DateTimeField()
+    unread_count = IntegerField(default=0)
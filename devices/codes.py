@@ -0,0 +1,146 @@
+import os
+from datetime import datetime, timedelta, timezone
+from peewee import TextField, DateTimeField
+import upstream
+from db import db, BaseModel, write_batches
+
+# Relist a mirrored device from Seam after this long, in case an event was missed
+MIRROR_MAX_AGE = timedelta(hours=int(os.environ.get("SEAM_MIRROR_MAX_AGE_HOURS", 24)))
+
+
+class DeviceCode(BaseModel):
+    """Local mirror of the access codes on each Seam device.
+
+    Seeded by listing a device, then kept current by Seam webhook events
+    (seam_webhook) and by the codes sync itself creates and deletes.
+    """
+    access_code_id = TextField(primary_key=True)
+    device_id = TextField()
+    code = TextField(null=True)
+    name = TextField(null=True)
+    starts_at = TextField(null=True)
+    ends_at = TextField(null=True)
+    status = TextField(null=True)
+
+
+class MirroredDevice(BaseModel):
+    """Devices whose DeviceCode rows are complete, and when they were last listed."""
+    device_id = TextField(primary_key=True)
+    listed_at = DateTimeField()
+
+
+def mirror_enabled():
+    # Without webhooks nothing keeps the mirror current between listings
+    return bool(os.environ.get("SEAM_WEBHOOK_SECRET"))
+
+
+def code_row(code):
+    return dict(
+        access_code_id=code["access_code_id"],
+        device_id=code["device_id"],
+        code=code.get("code"),
+        name=code.get("name"),
+        starts_at=code.get("starts_at"),
+        ends_at=code.get("ends_at"),
+        status=code.get("status"),
+    )
+
+
+def mirrored_codes(device_id):
+    """The device's codes from the mirror, or None if it isn't mirrored or is due a relist."""
+    if not mirror_enabled():
+        return None
+    device = MirroredDevice.get_or_none(MirroredDevice.device_id == device_id)
+    if not device or datetime.now(timezone.utc) - device.listed_at > MIRROR_MAX_AGE:
+        return None
+    return list(DeviceCode.select().where(DeviceCode.device_id == device_id).dicts())
+
+
+def replace_mirror(device_id, codes):
+    """Replace the device's mirrored codes with a fresh listing."""
+    with db.atomic():
+        DeviceCode.delete().where(DeviceCode.device_id == device_id).execute()
+        for batch in write_batches([code_row({**c, "device_id": device_id}) for c in codes]):
+            DeviceCode.replace_many(batch).execute()
+        MirroredDevice.replace(device_id=device_id, listed_at=datetime.now(timezone.utc)).execute()
+
+
+def mirror_code(code):
+    DeviceCode.replace(**code_row(code)).execute()
+
+
+def forget_code(access_code_id):
+    DeviceCode.delete().where(DeviceCode.access_code_id == access_code_id).execute()
+
+
+class CodeSnapshot:
+    """Access codes on each Seam device, read at most once per sync run.
+
+    Room and common lock sync share one snapshot so a device's codes are
+    loaded once, however many stays or reservations point at it. Codes
+    come from the DeviceCode mirror when webhooks keep it current, and
+    from access_codes/list (which reseeds the mirror) otherwise.
+    """
+
+    def __init__(self):
+        self._devices = {}
+
+    def _load(self, device_id, key):
+        if device_id not in self._devices:
+            codes = mirrored_codes(device_id)
+            if codes is None:
+                resp = upstream.seam.post(
+                    "access_codes/list", key=key, idempotent=True,
+                    json={"device_id": device_id}
+                )
+                if not resp.ok:
+                    # Don't cache the failure; the next lookup retries the list
+                    print(f"Failed to list access codes on device {device_id}: {resp.text}")
+                    return None
+                codes = resp.json().get("access_codes", [])
+                if mirror_enabled():
+                    replace_mirror(device_id, codes)
+            self._devices[device_id] = {
+                "by_code": {c["code"]: c for c in codes},
+                "by_id": {c["access_code_id"]: c for c in codes},
+            }
+        return self._devices[device_id]
+
+    def prefetch(self, seam, locks):
+        """List every lock's device up front, concurrently through a SeamExecutor."""
+        devices = {l["device"]: l for l in locks if l["device"] not in self._devices}
+        jobs = [
+            (device, seam.submit(l["key_env"], self._load, device, l["key"]))
+            for device, l in devices.items()
+        ]
+        for _ in seam.gather(jobs):
+            pass
+
+    def find_pin(self, device_id, key, pin):
+        """Return the code on the device with this PIN, if any."""
+        index = self._load(device_id, key)
+        return index["by_code"].get(pin) if index else None
+
+    def has_code(self, device_id, key, access_code_id):
+        """False only if the device was listed and the code isn't on it."""
+        index = self._load(device_id, key)
+        return access_code_id in index["by_id"] if index else True
+
+    def add(self, device_id, code):
+        """Record a code created during this run."""
+        if mirror_enabled():
+            mirror_code({**code, "device_id": device_id})
+        if device_id in self._devices:
+            self._devices[device_id]["by_code"][code["code"]] = code
+            self._devices[device_id]["by_id"][code["access_code_id"]] = code
+
+    def remove(self, device_id, access_code_id):
+        """Forget a code deleted during this run."""
+        if mirror_enabled():
+            forget_code(access_code_id)
+        index = self._devices.get(device_id)
+        if not index:
+            return
+        code = index["by_id"].pop(access_code_id, None)
+        if code and index["by_code"].get(code["code"]) is code:
+            del index["by_code"][code["code"]]
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_WORKERS = int(os.environ.get("SEAM_MAX_WORKERS", 8))
+# Requests per second (and burst size) allowed per Seam API key
+RATE_PER_SECOND = float(os.environ.get("SEAM_RATE_PER_SECOND", 5))
+BURST = int(os.environ.get("SEAM_BURST", 10))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Shared by every executor so concurrent runs (sync, webhooks) share one budget
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def bucket_for(key_env):
+    with _buckets_lock:
+        if key_env not in _buckets:
+            _buckets[key_env] = TokenBucket(RATE_PER_SECOND, BURST)
+        return _buckets[key_env]
+
+
+class FailedCall:
+    """Stands in for the response of a call that raised, e.g. a timeout.
+
+    Falsy `ok` and the error as `text`, so callers log it like any other
+    failed response and still apply the rest of the batch.
+    """
+    ok = False
+    status_code = None
+
+    def __init__(self, error):
+        self.error = error
+        self.text = repr(error)
+
+
+class SeamExecutor:
+    """Runs Seam API calls in parallel, rate limited per Lock.api_key_env.
+
+    Submit calls as (context, future) jobs, then walk `gather(jobs)` to apply
+    the results in one pass:
+
+        with SeamExecutor() as seam:
+            jobs = [(stay, seam.submit(lock["key_env"], upstream.seam.post, ...)) ...]
+            for stay, resp in seam.gather(jobs):
+                ...
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="seam")
+
+    def submit(self, key_env, fn, *args, **kwargs):
+        bucket = bucket_for(key_env)
+
+        def call():
+            bucket.acquire()
+            return fn(*args, **kwargs)
+
+        return self.pool.submit(call)
+
+    def gather(self, jobs):
+        """Yield (context, result) for each job, in submission order.
+
+        A job that raised yields a FailedCall instead, so one timeout
+        doesn't lose the results of the others.
+        """
+        for context, future in jobs:
+            try:
+                result = future.result()
+            except Exception as e:
+                result = FailedCall(e)
+            yield context, result
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
@@ -1,77 +1,209 @@
-from flask import Blueprint, render_template, request, jsonify
-from db import RoomStay, ChatMessage
+import hashlib
+import json
+import queue
+from datetime import datetime, timezone
+from peewee import fn, EXCLUDED
+from flask import Blueprint, Response, make_response, render_template, request, jsonify
+from werkzeug.http import is_resource_modified
+from db import db, RoomStay, ChatMessage, ChatMessageArchive, ConversationSummary
+from pubsub import chat_hub
+from reservations.cache import reservation_version
+
+# Seconds between SSE keepalive comments, so proxies don't drop idle streams
+KEEPALIVE = 15
+# Messages per history page, by default and at most
+HISTORY_LIMIT = 50
+MAX_HISTORY_LIMIT = 200
+# Phones may keep guest pages but must revalidate; unchanged pages get a 304
+PAGE_CACHE_CONTROL = "private, no-cache"
+# Templates only change on deploy, i.e. with a restart
+STARTED = datetime.now(timezone.utc)
 
 guest_bp = Blueprint('guest', __name__, template_folder='templates', static_folder='static', url_prefix='/guest')
 
 
-def get_stays_or_404(reservation_id):
-    stays = list(RoomStay.select().where(RoomStay.reservation_id == reservation_id))
-    return stays if stays else None
+def message_dict(m):
+    return {"id": m.id, "sender": m.sender, "message": m.message, "created_at": str(m.created_at)}
+
+
+def save_message(reservation_id, sender, message):
+    """Insert a chat message and roll it into the conversation summary."""
+    with db.atomic():
+        msg = ChatMessage.create(reservation_id=reservation_id, sender=sender, message=message)
+        stay = (RoomStay.select(RoomStay.guest_name)
+                .where(RoomStay.reservation_id == reservation_id).first())
+        unread = ConversationSummary.unread_count + 1 if sender == "guest" else 0
+        ConversationSummary.insert(
+            reservation_id=reservation_id,
+            guest_name=stay.guest_name if stay else None,
+            last_message_id=msg.id,
+            last_message=msg.message,
+            last_sender=sender,
+            last_activity=msg.created_at,
+            unread_count=1 if sender == "guest" else 0,
+        ).on_conflict(
+            conflict_target=[ConversationSummary.reservation_id],
+            preserve=[ConversationSummary.last_message_id, ConversationSummary.last_message,
+                      ConversationSummary.last_sender, ConversationSummary.last_activity],
+            update={
+                ConversationSummary.guest_name: fn.COALESCE(EXCLUDED.guest_name, ConversationSummary.guest_name),
+                ConversationSummary.unread_count: unread,
+            },
+        ).execute()
+    return msg
+
+
+def publish_message(m):
+    chat_hub.publish(m.reservation_id, message_dict(m))
+
+
+def message_page(model, reservation_id, after=None, before=None, limit=HISTORY_LIMIT):
+    """Up to `limit` messages, oldest first: the first ones after `after`,
+    otherwise the last ones before `before` (or the newest)."""
+    query = model.select().where(model.reservation_id == reservation_id)
+    if after is not None:
+        return [message_dict(m) for m in query.where(model.id > after).order_by(model.id).limit(limit)]
+    if before is not None:
+        query = query.where(model.id < before)
+    return [message_dict(m) for m in reversed(list(query.order_by(model.id.desc()).limit(limit)))]
+
+
+def page_validators(version):
+    """ETag and Last-Modified for a guest page.
+
+    Pages only change with the reservation's stays or a deploy, so the
+    reservation's date_modified and the process start time cover them.
+    """
+    etag = hashlib.sha1(f"{STARTED.isoformat()}|{version}|{request.path}".encode()).hexdigest()
+    modified = datetime.fromisoformat(version).replace(tzinfo=timezone.utc) if version else STARTED
+    return etag, max(modified, STARTED).replace(microsecond=0)
+
+
+def guest_page(reservation_id, template, stays=None, **context):
+    """Render a guest page, or 404 / 304 without touching RoomStay.
+
+    `stays`, if given, is called to load extra rows only when the page
+    is actually rendered.
+    """
+    version = reservation_version(reservation_id)
+    if version is None:
+        return "Not found", 404
+    etag, last_modified = page_validators(version)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        resp = Response(status=304)
+    else:
+        if stays:
+            context["stays"] = stays()
+        resp = make_response(render_template(template, reservation_id=reservation_id, **context))
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    resp.headers["Cache-Control"] = PAGE_CACHE_CONTROL
+    return resp
 
 
 @guest_bp.route('/<reservation_id>')
 def reservation(reservation_id):
-    stays = get_stays_or_404(reservation_id)
-    if not stays:
-        return "Not found", 404
-    return render_template('booking.html', reservation_id=reservation_id, stays=stays, page='booking')
+    return guest_page(
+        reservation_id, 'booking.html', page='booking',
+        stays=lambda: list(
+            RoomStay.select(RoomStay.room_name, RoomStay.room_check_in,
+                            RoomStay.room_check_out, RoomStay.room_status)
+            .where(RoomStay.reservation_id == reservation_id)
+        ),
+    )
 
 
 @guest_bp.route('/<reservation_id>/chat')
 def chat(reservation_id):
-    if not get_stays_or_404(reservation_id):
-        return "Not found", 404
-    return render_template('chat.html', reservation_id=reservation_id, page='messages')
+    return guest_page(reservation_id, 'chat.html', page='messages', history_limit=HISTORY_LIMIT)
 
 
 @guest_bp.route('/<reservation_id>/activities')
 def activities(reservation_id):
-    if not get_stays_or_404(reservation_id):
-        return "Not found", 404
-    return render_template('activities.html', reservation_id=reservation_id, page='activities')
+    return guest_page(reservation_id, 'activities.html', page='activities')
 
 
 @guest_bp.route('/<reservation_id>/food')
 def food(reservation_id):
-    if not get_stays_or_404(reservation_id):
-        return "Not found", 404
-    return render_template('food.html', reservation_id=reservation_id, page='food')
+    return guest_page(reservation_id, 'food.html', page='food')
 
 
 @guest_bp.route('/<reservation_id>/food/reserve')
 def food_reserve(reservation_id):
-    if not get_stays_or_404(reservation_id):
-        return "Not found", 404
-    return render_template('food_reserve.html', reservation_id=reservation_id, page='food',
-                           title='Book a Table', back_url=f'/guest/{reservation_id}/food')
+    return guest_page(reservation_id, 'food_reserve.html', page='food',
+                      title='Book a Table', back_url=f'/guest/{reservation_id}/food')
 
 
 @guest_bp.route('/<reservation_id>/profile')
 def profile(reservation_id):
-    if not get_stays_or_404(reservation_id):
-        return "Not found", 404
-    return render_template('profile.html', reservation_id=reservation_id, page='profile')
+    return guest_page(reservation_id, 'profile.html', page='profile')
 
 
 @guest_bp.route('/<reservation_id>/messages')
 def messages(reservation_id):
-    msgs = list(
-        ChatMessage.select()
-        .where(ChatMessage.reservation_id == reservation_id)
-        .order_by(ChatMessage.created_at)
-    )
-    return jsonify([
-        {"sender": m.sender, "message": m.message, "created_at": str(m.created_at)}
-        for m in msgs
-    ])
+    """Chat history, a page at a time.
+
+    ?after=<id> returns newer messages (live conversations only);
+    ?before=<id>, or no cursor, returns the page before it, continuing
+    into the archive once the hot table runs out.
+    """
+    limit = max(1, min(request.args.get("limit", HISTORY_LIMIT, type=int), MAX_HISTORY_LIMIT))
+    after = request.args.get("after", type=int)
+    if after is not None:
+        return jsonify(message_page(ChatMessage, reservation_id, after=after, limit=limit))
+    before = request.args.get("before", type=int)
+    msgs = message_page(ChatMessage, reservation_id, before=before, limit=limit)
+    if len(msgs) < limit:
+        oldest = msgs[0]["id"] if msgs else before
+        msgs = message_page(ChatMessageArchive, reservation_id, before=oldest, limit=limit - len(msgs)) + msgs
+    return jsonify(msgs)
+
+
+@guest_bp.route('/<reservation_id>/events')
+def events(reservation_id):
+    """Server-Sent Events stream of a reservation's chat messages.
+
+    Replays history after Last-Event-ID (the latest page on first connect),
+    then pushes each new message as it is posted.
+    """
+    # A malformed cursor gets the plain replay, as on first connect
+    try:
+        last_id = int(request.headers.get("Last-Event-ID", ""))
+    except ValueError:
+        last_id = request.args.get("after", 0, type=int)
+    # Subscribe before reading history so nothing posted in between is missed
+    q = chat_hub.subscribe(reservation_id)
+    if last_id:
+        backlog = message_page(ChatMessage, reservation_id, after=last_id, limit=None)
+    else:
+        backlog = message_page(ChatMessage, reservation_id)
+
+    def stream():
+        sent = last_id
+        try:
+            for msg in backlog:
+                sent = msg["id"]
+                yield f"id: {msg['id']}\ndata: {json.dumps(msg)}\n\n"
+            while True:
+                try:
+                    msg = q.get(timeout=KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if msg["id"] <= sent:
+                    continue
+                sent = msg["id"]
+                yield f"id: {msg['id']}\ndata: {json.dumps(msg)}\n\n"
+        finally:
+            chat_hub.unsubscribe(reservation_id, q)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @guest_bp.route('/<reservation_id>/messages', methods=['POST'])
 def post_message(reservation_id):
     data = request.get_json()
-    ChatMessage.create(
-        reservation_id=reservation_id,
-        sender="guest",
-        message=data.get("message", "").strip()
-    )
+    msg = save_message(reservation_id, "guest", data.get("message", "").strip())
+    publish_message(msg)
     return jsonify({"success": True})
@@ -0,0 +1,43 @@
+import os
+from datetime import datetime, timedelta, timezone
+from peewee import fn
+from db import RoomStay, ChatMessage, ChatMessageArchive, ConversationSummary, write_batches
+from worker import Worker
+
+# Archive a conversation once its stays are gone and it's been quiet this long
+ARCHIVE_AFTER = timedelta(days=int(os.environ.get("CHAT_ARCHIVE_AFTER_DAYS", 30)))
+# Conversations moved per write transaction
+ARCHIVE_BATCH_SIZE = 50
+
+
+def archive_conversations(progress=None):
+    """Move conversations for departed reservations into ChatMessageArchive.
+
+    A reservation counts as departed once sync has deleted its RoomStay
+    rows. Each batch copies and deletes in one transaction, and drops the
+    conversations from the staff sidebar.
+    """
+    cutoff = datetime.now(timezone.utc) - ARCHIVE_AFTER
+    departed = [
+        m.reservation_id for m in ChatMessage.select(ChatMessage.reservation_id)
+        .where(ChatMessage.reservation_id.not_in(RoomStay.select(RoomStay.reservation_id)))
+        .group_by(ChatMessage.reservation_id)
+        .having(fn.MAX(ChatMessage.created_at) < cutoff)
+    ]
+    moved = 0
+    for i, batch in enumerate(write_batches(departed, ARCHIVE_BATCH_SIZE)):
+        ChatMessageArchive.insert_from(
+            ChatMessage.select(ChatMessage.id, ChatMessage.reservation_id, ChatMessage.sender,
+                               ChatMessage.message, ChatMessage.created_at)
+            .where(ChatMessage.reservation_id.in_(batch)),
+            [ChatMessageArchive.id, ChatMessageArchive.reservation_id, ChatMessageArchive.sender,
+             ChatMessageArchive.message, ChatMessageArchive.created_at],
+        ).execute()
+        moved += ChatMessage.delete().where(ChatMessage.reservation_id.in_(batch)).execute()
+        ConversationSummary.delete().where(ConversationSummary.reservation_id.in_(batch)).execute()
+        if progress:
+            progress(f"archived {min((i + 1) * ARCHIVE_BATCH_SIZE, len(departed))}/{len(departed)} conversations")
+    print(f"Archived {moved} messages from {len(departed)} conversations")
+
+
+archive_worker = Worker("chat-archive", archive_conversations, timedelta(days=1))
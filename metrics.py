@@ -0,0 +1,196 @@
+"""In-process metrics, rendered in Prometheus text format at /metrics.
+
+Counters and histograms live in memory for the life of the process.
+Sync runs are also summarised in the sync_run table, one row per run,
+with per-phase timings and query counts for longer-term trends.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from peewee import AutoField, TextField, FloatField, DateTimeField
+from playhouse.sqlite_ext import JSONField
+from db import BaseModel, query_count
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# sync_run rows older than this are dropped as new runs are recorded
+RUN_RETENTION = timedelta(days=90)
+
+HELP = {
+    "upstream_requests_total": ("counter", "Upstream API calls by endpoint and status"),
+    "upstream_request_seconds": ("histogram", "Upstream API call latency by endpoint and status"),
+    "sync_phase_seconds": ("histogram", "Time spent in each sync phase"),
+    "sync_phase_queries_total": ("counter", "SQLite queries issued by the sync thread in each phase"),
+    "sync_runs_total": ("counter", "Sync runs by kind and outcome"),
+    "sync_last_run_seconds": ("gauge", "Duration of the most recent sync run of each kind"),
+    "outbox_tasks": ("gauge", "OTA follow-up tasks by status; failed and review need staff"),
+    "reservation_sync_abandoned_total": ("counter", "Webhook-queued reservation syncs dropped after MAX_ATTEMPTS"),
+}
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_gauges = {}      # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_current = threading.local()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, labels, value=1):
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, labels, value):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, labels, seconds):
+    with _lock:
+        h = _histograms.setdefault(_key(name, labels), [0] * len(BUCKETS) + [0.0, 0])
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                h[i] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+
+class SyncRun(BaseModel):
+    id = AutoField()
+    kind = TextField()
+    started_at = DateTimeField()
+    duration = FloatField(null=True)
+    phases = JSONField(default=dict)    # phase -> {"seconds", "queries"}
+    counts = JSONField(default=dict)    # e.g. reservations found, stays saved
+    upstream = JSONField(default=dict)  # "api endpoint" -> calls made during the run
+    error = TextField(null=True)
+
+    class Meta:
+        table_name = "sync_run"
+
+
+def upstream_calls():
+    import upstream
+    return {
+        f"{api} {endpoint}": s["calls"]
+        for api, endpoints in upstream.stats().items()
+        for endpoint, s in endpoints.items()
+    }
+
+
+@contextmanager
+def recording(kind):
+    """Record the enclosed sync run: its phases, counts and upstream calls."""
+    run = {"phases": {}, "counts": {}}
+    started = datetime.now(timezone.utc)
+    clock = time.perf_counter()
+    calls_before = upstream_calls()
+    _current.run = run
+    error = None
+    try:
+        yield run
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        _current.run = None
+        duration = time.perf_counter() - clock
+        calls = {k: v - calls_before.get(k, 0) for k, v in upstream_calls().items()}
+        for name, p in run["phases"].items():
+            _observe_phase(name, p["seconds"], p["queries"])
+        inc("sync_runs_total", {"kind": kind, "outcome": "error" if error else "ok"})
+        set_gauge("sync_last_run_seconds", {"kind": kind}, duration)
+        SyncRun.create(
+            kind=kind, started_at=started, duration=duration, phases=run["phases"],
+            counts=run["counts"], upstream={k: v for k, v in calls.items() if v}, error=error,
+        )
+        SyncRun.delete().where(SyncRun.started_at < started - RUN_RETENTION).execute()
+
+
+def _observe_phase(name, seconds, queries):
+    observe("sync_phase_seconds", {"phase": name}, seconds)
+    inc("sync_phase_queries_total", {"phase": name}, queries)
+
+
+@contextmanager
+def phase(name):
+    """Time the enclosed block as sync phase `name`.
+
+    Within a recorded run, repeats of a phase add up and are exported
+    once, as the run's total for it.
+    """
+    clock = time.perf_counter()
+    queries = query_count()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - clock
+        queries = query_count() - queries
+        run = getattr(_current, "run", None)
+        if run is None:
+            _observe_phase(name, seconds, queries)
+        else:
+            p = run["phases"].setdefault(name, {"seconds": 0.0, "queries": 0})
+            p["seconds"] += seconds
+            p["queries"] += queries
+
+
+def timed(iterable, name):
+    """Yield from `iterable`, timing each step as phase `name`."""
+    it = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+def count(**counts):
+    """Add to the current run's counts."""
+    run = getattr(_current, "run", None)
+    if run is not None:
+        for k, v in counts.items():
+            run["counts"][k] = run["counts"].get(k, 0) + v
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ""
+    def escape(v):
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+
+def render():
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+
+    lines = []
+    for name, (kind, text) in HELP.items():
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "histogram":
+            for (n, labels), h in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for bound, c in zip(BUCKETS, h):
+                    lines.append(f"{name}_bucket{_labels(labels, le=bound)} {c}")
+                lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {h[-1]}')
+                lines.append(f"{name}_sum{_labels(labels)} {h[-2]}")
+                lines.append(f"{name}_count{_labels(labels)} {h[-1]}")
+        else:
+            source = counters if kind == "counter" else gauges
+            for (n, labels), value in sorted(source.items()):
+                if n == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,185 @@
+"""Versioned schema migrations.
+
+Each migration runs once, in version order, and is recorded in the
+schemaversion table. server.py applies pending migrations at startup;
+`python migrate.py` does the same by hand. Migrations must be safe on a
+fresh database too, where db.create_tables() has already built the
+current schema, so column changes check before altering. A migration
+that indexes a table added since the baseline creates that table first
+(create_tables skips existing ones), so running them by hand on an old
+database works without server.py.
+"""
+import json
+from datetime import datetime, timezone
+from peewee import IntegerField, TextField, DateTimeField
+from playhouse.migrate import SqliteMigrator, migrate
+from db import db, BaseModel, ReservationPayload, ChatMessageArchive, ConversationSummary
+
+migrator = SqliteMigrator(db)
+MIGRATIONS = []
+
+
+class SchemaVersion(BaseModel):
+    version = IntegerField(primary_key=True)
+    name = TextField()
+    applied_at = DateTimeField(default=lambda: datetime.now(timezone.utc))
+
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+
+def columns(table):
+    return {c.name: c for c in db.get_columns(table)}
+
+
+def add_column(table, name, field):
+    if name not in columns(table):
+        migrate(migrator.add_column(table, name, field))
+
+
+@migration(1, "lock category, nullable room_id")
+def lock_category():
+    add_column("lock", "category", TextField(null=True))
+    if not columns("lock")["room_id"].null:
+        migrate(migrator.drop_not_null("lock", "room_id"))
+
+
+@migration(2, "seam_window on roomstay and commoncode")
+def seam_window():
+    add_column("roomstay", "seam_window", TextField(null=True))
+    add_column("commoncode", "seam_window", TextField(null=True))
+
+
+@migration(3, "hot-path indexes")
+def hot_path_indexes():
+    db.execute_sql("CREATE INDEX IF NOT EXISTS roomstay_reservation_id ON roomstay (reservation_id)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS roomstay_res_status ON roomstay (res_status)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS roomstay_seam_access_code_id ON roomstay (seam_access_code_id)")
+    db.execute_sql(
+        "CREATE INDEX IF NOT EXISTS chatmessage_reservation_id_created_at "
+        "ON chatmessage (reservation_id, created_at)"
+    )
+    # Keep one row per (reservation, lock) — the one with a Seam code if any
+    db.execute_sql(
+        "DELETE FROM commoncode WHERE id NOT IN ("
+        " SELECT COALESCE(MAX(CASE WHEN seam_access_code_id IS NOT NULL THEN id END), MAX(id))"
+        " FROM commoncode GROUP BY reservation_id, lock_id)"
+    )
+    db.execute_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS commoncode_reservation_id_lock_id "
+        "ON commoncode (reservation_id, lock_id)"
+    )
+
+
+@migration(4, "chat history cursor indexes")
+def chat_cursor_indexes():
+    # History is paged by id now; (reservation_id, id) serves both cursors
+    db.execute_sql("DROP INDEX IF EXISTS chatmessage_reservation_id_created_at")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS chatmessage_reservation_id_id ON chatmessage (reservation_id, id)")
+    db.create_tables([ChatMessageArchive])
+    db.execute_sql(
+        "CREATE INDEX IF NOT EXISTS chatmessagearchive_reservation_id_id "
+        "ON chatmessagearchive (reservation_id, id)"
+    )
+
+
+@migration(5, "conversation summaries")
+def conversation_summaries():
+    db.create_tables([ConversationSummary])
+    db.execute_sql(
+        "CREATE INDEX IF NOT EXISTS conversationsummary_last_message_id "
+        "ON conversationsummary (last_message_id)"
+    )
+    # Backfill from the latest message per conversation; unread means guest
+    # messages after the last staff reply
+    db.execute_sql(
+        "INSERT OR REPLACE INTO conversationsummary"
+        " (reservation_id, guest_name, last_message_id, last_message, last_sender, last_activity, unread_count)"
+        " SELECT m.reservation_id,"
+        "  (SELECT guest_name FROM roomstay r WHERE r.reservation_id = m.reservation_id LIMIT 1),"
+        "  m.id, m.message, m.sender, m.created_at,"
+        "  (SELECT COUNT(*) FROM chatmessage g WHERE g.reservation_id = m.reservation_id"
+        "   AND g.sender = 'guest' AND g.id > COALESCE((SELECT MAX(s.id) FROM chatmessage s"
+        "   WHERE s.reservation_id = m.reservation_id AND s.sender = 'staff'), 0))"
+        " FROM chatmessage m"
+        " WHERE m.id IN (SELECT MAX(id) FROM chatmessage GROUP BY reservation_id)"
+    )
+
+
+@migration(6, "dashboard keyset index")
+def dashboard_index():
+    db.execute_sql("CREATE INDEX IF NOT EXISTS roomstay_room_check_in_id ON roomstay (room_check_in, id)")
+
+
+@migration(7, "move roomstay.data to compressed reservationpayload")
+def reservation_payloads():
+    if "data" not in columns("roomstay"):
+        return
+    db.create_tables([ReservationPayload])
+    # One payload per reservation: the most recently modified room's copy
+    rows = db.execute_sql(
+        "SELECT reservation_id, date_modified, data FROM roomstay"
+        " WHERE id IN (SELECT id FROM roomstay r WHERE r.reservation_id = roomstay.reservation_id"
+        "  ORDER BY date_modified DESC LIMIT 1)"
+    )
+    for reservation_id, date_modified, data in rows.fetchall():
+        ReservationPayload.replace(
+            reservation_id=reservation_id,
+            date_modified=date_modified,
+            blob=ReservationPayload.encode(json.loads(data)),
+        ).execute()
+    migrate(migrator.drop_column("roomstay", "data"))
+
+
+@migration(8, "seam event queue and device code mirror indexes")
+def seam_event_indexes():
+    from devices.codes import DeviceCode, MirroredDevice
+    from seam_webhook.events import SeamEvent
+    db.create_tables([SeamEvent, DeviceCode, MirroredDevice])
+    db.execute_sql("CREATE UNIQUE INDEX IF NOT EXISTS seamevent_event_id ON seamevent (event_id)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS seamevent_processed_at ON seamevent (processed_at)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS devicecode_device_id ON devicecode (device_id)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS commoncode_seam_access_code_id ON commoncode (seam_access_code_id)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS roomblockcode_seam_code_id ON roomblockcode (seam_code_id)")
+
+
+@migration(9, "sync request queue index")
+def sync_request_index():
+    from reservations.webhook import SyncRequest
+    db.create_tables([SyncRequest])
+    db.execute_sql("CREATE INDEX IF NOT EXISTS syncrequest_due_at ON syncrequest (due_at)")
+
+
+@migration(10, "ota outbox indexes")
+def ota_outbox_indexes():
+    from ota.outbox import OutboxTask
+    db.create_tables([OutboxTask])
+    db.execute_sql("CREATE UNIQUE INDEX IF NOT EXISTS outboxtask_idempotency_key ON outboxtask (idempotency_key)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS outboxtask_status_next_attempt_at ON outboxtask (status, next_attempt_at)")
+
+
+@migration(11, "sync run index")
+def sync_run_index():
+    from metrics import SyncRun
+    db.create_tables([SyncRun])
+    db.execute_sql("CREATE INDEX IF NOT EXISTS sync_run_started_at ON sync_run (started_at)")
+
+
+def run_migrations():
+    db.create_tables([SchemaVersion])
+    applied = {v.version for v in SchemaVersion.select(SchemaVersion.version)}
+    for version, name, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        with db.atomic():
+            fn()
+            SchemaVersion.create(version=version, name=name)
+        print(f"Applied migration {version}: {name}")
+
+
+if __name__ == "__main__":
+    run_migrations()
@@ -1,16 +1,27 @@
 import json
-from datetime import date, timedelta
 from flask import Blueprint, request, render_template, jsonify
+from db import db
+from worker import Worker
+from reservations.webhook import enqueue as enqueue_sync, reservation_worker
 from .api import (
-    get_reservations, get_reservations_with_details, get_rate_plans,
-    post_reservation, post_adjustment, post_note, put_note, get_notes
+    get_rate_plans, post_reservation, post_note, put_note, get_notes
 )
+from . import index as reservation_index
+from .outbox import enqueue as enqueue_followup, outbox_worker
 
 ota_bp = Blueprint('ota', __name__, template_folder='templates', static_folder='static', static_url_path='/ota/static')
 
 with open("ota_config.json") as f:
     CONFIG = json.load(f)
 
+SOURCE_IDS = {u["sourceID"] for u in CONFIG.get("users", {}).values() if u.get("sourceID")}
+# Seconds a request waits for the first index build before giving up
+COLD_INDEX_WAIT = 120
+index_worker = Worker(
+    "ota-index",
+    lambda progress, **kwargs: reservation_index.refresh(SOURCE_IDS, progress=progress, **kwargs)
+)
+
 
 def get_username():
     """Get username from header, with query param fallback for local dev."""
@@ -40,25 +51,18 @@ def api_reservations():
     if not source_id:
         return jsonify({"error": "No sourceID configured"}), 403
 
-    check_in_from = (date.today() - timedelta(days=30)).isoformat()
-    check_in_to = (date.today() + timedelta(days=730)).isoformat()
-
-    matching_ids = []
-    page = 1
-    while True:
-        data = get_reservations(check_in_from, check_in_to, page)
-        for res in data.get("data", []):
-            if res.get("sourceID") == source_id:
-                matching_ids.append(res["reservationID"])
-        if len(data.get("data", [])) < 100:
-            break
-        page += 1
+    # Answer from the local index; refresh it in the background when stale.
+    # The first build also runs on the worker, so concurrent requests share it
+    if not reservation_index.is_built():
+        index_worker.start()
+        index_worker.wait(index_worker.trigger(), COLD_INDEX_WAIT)
+        if not reservation_index.is_built():
+            return jsonify({"error": "Reservation index is still building, try again shortly"}), 503
+    elif reservation_index.is_stale():
+        index_worker.start()
+        index_worker.trigger()
 
-    if not matching_ids:
-        return jsonify([])
-
-    details = get_reservations_with_details(matching_ids)
-    return jsonify(details.get("data", []))
+    return jsonify(reservation_index.reservations_for(source_id))
 
 
 @ota_bp.route('/ota/availability', methods=['POST'])
@@ -198,26 +202,26 @@ def create_reservation():
     reservation_id = res_result.get("reservationID")
     grand_total = float(res_result.get("grandTotal", 0))
 
-    # Calculate and post adjustment
+    # Follow-ups go through the outbox so the partner isn't kept waiting
+    # on them and a failure is retried rather than lost
     tax_rate = defaults.get("taxRate", 0.15)
     adjustment_percent = user_config.get("adjustmentPercent", 0)
     adjustment_amount = grand_total / (1 + tax_rate) * adjustment_percent
 
-    if adjustment_amount != 0:
-        adj_result = post_adjustment(
-            reservation_id,
-            round(adjustment_amount, 2),
-            f"{user_config.get('displayName', username)} commission adjustment"
-        )
-        if not adj_result.get("success"):
-            return jsonify({"error": "Reservation created but adjustment failed"}), 500
-
-    # Post note if provided
-    if notes.strip():
-        note_result = post_note(reservation_id, notes)
-        if not note_result.get("success"):
-            return jsonify({"error": "Reservation created but note failed"}), 500
-
+    with db.atomic():
+        if adjustment_amount != 0:
+            enqueue_followup("adjustment", reservation_id, {
+                "amount": round(adjustment_amount, 2),
+                "notes": f"{user_config.get('displayName', username)} commission adjustment",
+            })
+        if notes.strip():
+            enqueue_followup("note", reservation_id, {"note": notes})
+        # Door codes: sync the new reservation now rather than at the next full sync
+        enqueue_sync(str(reservation_id), "ota/created")
+
+    for worker in (outbox_worker, reservation_worker, index_worker):
+        worker.start()
+        worker.trigger()
     return jsonify({"success": True, "reservationID": reservation_id})
 
 
@@ -1,72 +1,98 @@
 import os
-import requests
+import threading
+import time
+from concurrent.futures import Future
 from dotenv import load_dotenv
+from upstream import cloudbeds
 
 load_dotenv()
 
-API_KEY = os.environ.get("CLOUDBEDS_API_KEY")
 PROPERTY_ID = os.environ.get("CLOUDBEDS_PROPERTY_ID")
-BASE_URL = "https://api.cloudbeds.com/api/v1.2"
 
+# Seconds a getRatePlans result is reused for the same (startDate, endDate)
+RATE_PLANS_TTL = 30
 
-def get_reservations(check_in_from, check_in_to, page=1, page_size=100):
-    """Fetch a page of reservations."""
-    resp = requests.get(
-        f"{BASE_URL}/getReservations",
-        headers={"Authorization": f"Bearer {API_KEY}"},
-        params={
-            "propertyID": PROPERTY_ID,
-            "checkInFrom": check_in_from,
-            "checkInTo": check_in_to,
-            "pageNumber": page,
-            "pageSize": page_size
-        }
-    )
-    return resp.json()
-
-
-def get_reservations_with_details(reservation_ids):
-    """Fetch detailed info for a list of reservation IDs."""
-    resp = requests.get(
-        f"{BASE_URL}/getReservationsWithRateDetails",
-        headers={"Authorization": f"Bearer {API_KEY}"},
-        params={
-            "propertyID": PROPERTY_ID,
-            "reservationID": ",".join(reservation_ids)
-        }
-    )
-    return resp.json()
+_rate_plans = {}
+_rate_plans_in_flight = {}
+_rate_plans_generation = 0
+_rate_plans_lock = threading.Lock()
 
 
 def get_rate_plans(start_date, end_date):
-    """Fetch rate plans with availability for date range."""
-    resp = requests.get(
-        f"{BASE_URL}/getRatePlans",
-        headers={"Authorization": f"Bearer {API_KEY}"},
-        params={
-            "propertyID": PROPERTY_ID,
-            "startDate": start_date,
-            "endDate": end_date
-        }
-    )
-    return resp.json()
+    """Fetch rate plans with availability for date range.
+
+    Successful results are cached for RATE_PLANS_TTL seconds, and concurrent
+    calls for the same range share one upstream request.
+    """
+    key = (start_date, end_date)
+    with _rate_plans_lock:
+        cached = _rate_plans.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        future = _rate_plans_in_flight.get(key)
+        if future is None:
+            future = _rate_plans_in_flight[key] = Future()
+            generation = _rate_plans_generation
+        else:
+            generation = None
+
+    if generation is None:
+        return future.result()
+
+    try:
+        resp = cloudbeds.get(
+            "getRatePlans",
+            params={
+                "propertyID": PROPERTY_ID,
+                "startDate": start_date,
+                "endDate": end_date
+            }
+        )
+        result = resp.json()
+    except Exception as e:
+        with _rate_plans_lock:
+            del _rate_plans_in_flight[key]
+        future.set_exception(e)
+        raise
+
+    # Cache before dropping the in-flight entry, under one lock, so a call
+    # arriving in between finds one or the other and never refetches
+    with _rate_plans_lock:
+        # Don't cache a response that raced with a booking's invalidation
+        if result.get("success") and generation == _rate_plans_generation:
+            now = time.monotonic()
+            for k in [k for k, (expires, _) in _rate_plans.items() if expires <= now]:
+                del _rate_plans[k]
+            _rate_plans[key] = (now + RATE_PLANS_TTL, result)
+        del _rate_plans_in_flight[key]
+    future.set_result(result)
+    return result
+
+
+def invalidate_rate_plans():
+    """Drop cached availability, e.g. after a booking changes it."""
+    global _rate_plans_generation
+    with _rate_plans_lock:
+        _rate_plans.clear()
+        _rate_plans_generation += 1
 
 
 def post_reservation(payload):
     """Create reservation. payload is a flat dict with bracket notation keys."""
-    resp = requests.post(
-        f"{BASE_URL}/postReservation",
-        headers={"Authorization": f"Bearer {API_KEY}"},
+    resp = cloudbeds.post(
+        "postReservation",
         data=payload
     )
-    return resp.json()
+    result = resp.json()
+    if result.get("success"):
+        invalidate_rate_plans()
+    return result
 
 
 def post_adjustment(reservation_id, amount, notes):
     """Post folio adjustment (negative amount for discount)."""
-    resp = requests.post(
-        f"{BASE_URL}/postAdjustment",
-        headers={"Authorization": f"Bearer {API_KEY}"},
+    resp = cloudbeds.post(
+        "postAdjustment",
         data={
             "propertyID": PROPERTY_ID,
             "reservationID": reservation_id,
@@ -80,9 +106,8 @@ def post_adjustment(reservation_id, amount, notes):
 
 def get_notes(reservation_id):
     """Fetch notes for a reservation."""
-    resp = requests.get(
-        f"{BASE_URL}/getReservationNotes",
-        headers={"Authorization": f"Bearer {API_KEY}"},
+    resp = cloudbeds.get(
+        "getReservationNotes",
         params={"propertyID": PROPERTY_ID, "reservationID": reservation_id}
     )
     return resp.json()
@@ -90,9 +115,8 @@ def get_notes(reservation_id):
 
 def put_note(reservation_id, note_id, note):
     """Update an existing reservation note."""
-    resp = requests.put(
-        f"{BASE_URL}/putReservationNote",
-        headers={"Authorization": f"Bearer {API_KEY}"},
+    resp = cloudbeds.put(
+        "putReservationNote",
         data={
             "propertyID": PROPERTY_ID,
             "reservationID": reservation_id,
@@ -105,9 +129,8 @@ def put_note(reservation_id, note_id, note):
 
 def post_note(reservation_id, note):
     """Add note to reservation."""
-    resp = requests.post(
-        f"{BASE_URL}/postReservationNote",
-        headers={"Authorization": f"Bearer {API_KEY}"},
+    resp = cloudbeds.post(
+        "postReservationNote",
         data={
             "propertyID": PROPERTY_ID,
             "reservationID": reservation_id,
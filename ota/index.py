@@ -0,0 +1,102 @@
+import os
+from datetime import date, datetime, timedelta
+from peewee import TextField
+from playhouse.sqlite_ext import JSONField
+from db import BaseModel, write_batches
+from reservations.sync import get_state, set_state, incremental_since, iter_reservation_rows, iter_details
+
+# Serve from the index, but refresh in the background once it is this old
+STALE_AFTER = timedelta(minutes=1)
+# Incremental refreshes can't see reservations leaving the window
+FULL_REFRESH_INTERVAL = timedelta(hours=6)
+
+
+class OtaReservation(BaseModel):
+    reservation_id = TextField(primary_key=True)
+    source_id = TextField(index=True)
+    check_in = TextField()
+    date_modified = TextField()
+    data = JSONField()
+
+
+def window():
+    return (date.today() - timedelta(days=30)).isoformat(), (date.today() + timedelta(days=730)).isoformat()
+
+
+def is_built():
+    return get_state("ota_index_refreshed") is not None
+
+
+def is_stale():
+    refreshed = get_state("ota_index_refreshed")
+    return not refreshed or datetime.now() - datetime.fromisoformat(refreshed) > STALE_AFTER
+
+
+def refresh(source_ids, full=False, progress=None):
+    """Index reservations from the given OTA sources.
+
+    Incremental refreshes only page through reservations modified since the
+    last dateModified watermark; a full refresh rewalks the whole window and
+    drops anything no longer in it.
+    """
+    watermark, incremental = incremental_since(
+        "ota_index_modified", "ota_index_full", FULL_REFRESH_INTERVAL, full
+    )
+    started = datetime.now()
+    check_in_from, check_in_to = window()
+    params = {
+        "propertyID": os.environ.get("CLOUDBEDS_PROPERTY_ID"),
+        "checkInFrom": check_in_from,
+        "checkInTo": check_in_to,
+    }
+    if incremental:
+        params["modifiedFrom"] = watermark
+
+    matching = {}
+    other = []
+    new_watermark = watermark or ""
+    for res in iter_reservation_rows(params):
+        new_watermark = max(new_watermark, res.get("dateModified") or "")
+        if res.get("sourceID") in source_ids:
+            matching[res["reservationID"]] = res["sourceID"]
+        else:
+            other.append(res["reservationID"])
+
+    rows = [
+        dict(
+            reservation_id=res["reservationID"],
+            source_id=matching[res["reservationID"]],
+            check_in=res["reservationCheckIn"],
+            date_modified=res["dateModified"],
+            data=res,
+        )
+        for res in iter_details(matching)
+    ]
+
+    if incremental:
+        # Reservations that moved to another source
+        gone = other
+    else:
+        indexed = {r.reservation_id for r in OtaReservation.select(OtaReservation.reservation_id)}
+        gone = list(indexed - set(matching))
+
+    for batch in write_batches(rows, 100):
+        OtaReservation.replace_many(batch).execute()
+    for batch in write_batches(gone, 500):
+        OtaReservation.delete().where(OtaReservation.reservation_id.in_(batch)).execute()
+
+    if new_watermark:
+        set_state("ota_index_modified", new_watermark)
+    if not incremental:
+        set_state("ota_index_full", started.isoformat())
+    set_state("ota_index_refreshed", started.isoformat())
+    print(f"OTA index: saved {len(rows)} reservations ({'incremental' if incremental else 'full'})")
+
+
+def reservations_for(source_id):
+    check_in_from, _ = window()
+    return [
+        r.data for r in OtaReservation.select(OtaReservation.data)
+        .where((OtaReservation.source_id == source_id) & (OtaReservation.check_in >= check_in_from))
+        .order_by(OtaReservation.check_in)
+    ]
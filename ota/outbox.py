@@ -0,0 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import requests
+from peewee import AutoField, TextField, IntegerField, DateTimeField, fn
+from playhouse.sqlite_ext import JSONField
+import metrics
+from db import db, BaseModel
+from worker import Worker
+from .api import post_adjustment, post_note, get_notes
+
+OUTBOX_WORKERS = 4
+# Retry after 30s, 1m, 2m, ... and give up after MAX_ATTEMPTS
+RETRY_BASE = timedelta(seconds=30)
+MAX_ATTEMPTS = 8
+
+
+class OutboxTask(BaseModel):
+    """A Cloudbeds follow-up to a booking, kept until it has been applied.
+
+    idempotency_key is unique, so a task is never queued twice. status is
+    pending, done, failed (out of attempts), review (the last attempt
+    may have applied; retrying could double it) or resolved (staff
+    dealt with a failed or review task, see /staff/outbox).
+    """
+    id = AutoField()
+    idempotency_key = TextField()
+    kind = TextField()
+    reservation_id = TextField()
+    payload = JSONField()
+    status = TextField(default="pending")
+    attempts = IntegerField(default=0)
+    next_attempt_at = DateTimeField(default=lambda: datetime.now(timezone.utc))
+    last_error = TextField(null=True)
+    created_at = DateTimeField(default=lambda: datetime.now(timezone.utc))
+    completed_at = DateTimeField(null=True)
+
+
+def enqueue(kind, reservation_id, payload):
+    OutboxTask.insert(
+        idempotency_key=f"{reservation_id}:{kind}",
+        kind=kind,
+        reservation_id=reservation_id,
+        payload=payload,
+    ).on_conflict_ignore().execute()
+
+
+def note_exists(reservation_id, note):
+    result = get_notes(reservation_id)
+    return any(n.get("reservationNote") == note for n in result.get("data", []) or [])
+
+
+def send_adjustment(task):
+    p = task.payload
+    return post_adjustment(task.reservation_id, p["amount"], p["notes"])
+
+
+def send_note(task):
+    # A timed-out attempt may have landed; notes can be checked, so do
+    if task.attempts and note_exists(task.reservation_id, task.payload["note"]):
+        return {"success": True}
+    return post_note(task.reservation_id, task.payload["note"])
+
+
+HANDLERS = {
+    "adjustment": send_adjustment,
+    "note": send_note,
+}
+# Kinds whose retries are safe after an ambiguous failure (request sent, no reply)
+CHECKED_KINDS = {"note"}
+# Statuses staff need to look at
+ATTENTION_STATUSES = ("failed", "review")
+
+
+def run_task(task):
+    """Attempt one task; returns (status, error)."""
+    try:
+        result = HANDLERS[task.kind](task)
+    except requests.ConnectTimeout as e:
+        # Never connected, so nothing was sent
+        return "retry", str(e)
+    except (requests.ReadTimeout, requests.ConnectionError) as e:
+        # The request may have been sent before the timeout or reset
+        if task.kind not in CHECKED_KINDS:
+            return "review", f"no response, may have applied: {e}"
+        return "retry", str(e)
+    except Exception as e:
+        return "retry", str(e)
+    if result.get("success"):
+        return "done", None
+    return "retry", result.get("message") or str(result)
+
+
+def record_counts():
+    """Export task counts by status as outbox_tasks{status=...}."""
+    counts = dict(OutboxTask.select(OutboxTask.status, fn.COUNT(OutboxTask.id)).group_by(OutboxTask.status).tuples())
+    for status in ("pending", "done", "failed", "review", "resolved"):
+        metrics.set_gauge("outbox_tasks", {"status": status}, counts.get(status, 0))
+
+
+def attention_tasks():
+    """Failed and review tasks, oldest first, for staff to resolve by hand."""
+    return list(
+        OutboxTask.select().where(OutboxTask.status.in_(ATTENTION_STATUSES)).order_by(OutboxTask.id)
+    )
+
+
+def drain(progress=None):
+    """Run every due task, OUTBOX_WORKERS at a time, rescheduling failures."""
+    now = datetime.now(timezone.utc)
+    due = list(
+        OutboxTask.select()
+        .where((OutboxTask.status == "pending") & (OutboxTask.next_attempt_at <= now))
+        .order_by(OutboxTask.id)
+    )
+    if not due:
+        record_counts()
+        return
+    with ThreadPoolExecutor(max_workers=OUTBOX_WORKERS, thread_name_prefix="outbox") as pool:
+        outcomes = list(zip(due, pool.map(run_task, due)))
+
+    done = 0
+    with db.atomic():
+        for task, (outcome, error) in outcomes:
+            attempts = task.attempts + 1
+            if outcome == "done":
+                done += 1
+                OutboxTask.update(status="done", attempts=attempts, last_error=None,
+                                  completed_at=datetime.now(timezone.utc)).where(OutboxTask.id == task.id).execute()
+                continue
+            status = "review" if outcome == "review" else "failed" if attempts >= MAX_ATTEMPTS else "pending"
+            OutboxTask.update(
+                status=status, attempts=attempts, last_error=error,
+                next_attempt_at=now + RETRY_BASE * 2 ** task.attempts,
+            ).where(OutboxTask.id == task.id).execute()
+            if status in ATTENTION_STATUSES:
+                print(f"ERROR: OTA {task.kind} for reservation {task.reservation_id} needs staff ({status}): {error}")
+            else:
+                print(f"OTA {task.kind} for reservation {task.reservation_id} {status}: {error}")
+    print(f"OTA outbox: {done}/{len(due)} tasks applied")
+    record_counts()
+
+
+# Triggered after each booking; the interval picks up retries
+outbox_worker = Worker("ota-outbox", drain, timedelta(seconds=30))
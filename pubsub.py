@@ -0,0 +1,33 @@
+import queue
+import threading
+from collections import defaultdict
+
+
+class Hub:
+    """In-process pub/sub: every subscriber gets its own queue per topic."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = defaultdict(set)
+
+    def subscribe(self, topic):
+        q = queue.Queue()
+        with self.lock:
+            self.subscribers[topic].add(q)
+        return q
+
+    def unsubscribe(self, topic, q):
+        with self.lock:
+            self.subscribers[topic].discard(q)
+            if not self.subscribers[topic]:
+                del self.subscribers[topic]
+
+    def publish(self, topic, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(topic, ()))
+        for q in subscribers:
+            q.put(message)
+
+
+# Chat messages, by reservation_id
+chat_hub = Hub()
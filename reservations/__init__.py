@@ -1,10 +1,60 @@
-from flask import Blueprint, redirect
+import hmac
+import os
+from datetime import timedelta
+from dotenv import load_dotenv
+from flask import Blueprint, redirect, request, jsonify
 from .sync import run as run_sync
+from .webhook import enqueue, reservation_worker
+from worker import Worker
+
+load_dotenv()
 
 reservations_bp = Blueprint("reservations", __name__)
 
+# Cloudbeds reservation webhooks that trigger a targeted sync
+WEBHOOK_EVENTS = {
+    "reservation/created", "reservation/status_changed", "reservation/dates_changed", "reservation/deleted",
+}
+
+# Scheduled sync every SYNC_INTERVAL_MINUTES (0 disables the schedule). With
+# webhooks configured this is only a safety net; 1440 (nightly) is plenty.
+interval = float(os.environ.get("SYNC_INTERVAL_MINUTES", 15))
+sync_worker = Worker("sync", run_sync, timedelta(minutes=interval) if interval else None)
+
 
 @reservations_bp.route("/sync")
 def sync():
-    run_sync()
+    # Same arguments as a scheduled run unless ?full=1, so a manual sync
+    # attaches to one already running instead of queueing another
+    if request.args.get("full") == "1":
+        sync_worker.trigger(full=True)
+    else:
+        sync_worker.trigger()
     return redirect("/")
+
+
+@reservations_bp.route("/sync/status")
+def sync_status():
+    return jsonify(sync_worker.status())
+
+
+@reservations_bp.route("/reservations/webhook", methods=["POST"])
+def reservation_webhook():
+    """Queue a sync of the reservation a Cloudbeds webhook is about.
+
+    The route bypasses basicauth, so it refuses everything until
+    CLOUDBEDS_WEBHOOK_TOKEN is set.
+    """
+    token = os.environ.get("CLOUDBEDS_WEBHOOK_TOKEN")
+    if not token:
+        return jsonify({"error": "Webhook token not configured"}), 503
+    if not hmac.compare_digest(request.args.get("token", ""), token):
+        return jsonify({"error": "Invalid token"}), 401
+
+    data = request.get_json(silent=True) or {}
+    if data.get("event") not in WEBHOOK_EVENTS or not data.get("reservationID"):
+        return jsonify({"skipped": True}), 200
+
+    enqueue(str(data["reservationID"]), data["event"])
+    reservation_worker.trigger()
+    return jsonify({"queued": True}), 202
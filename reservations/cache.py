@@ -0,0 +1,49 @@
+import threading
+from peewee import fn
+from db import RoomStay
+
+# reservation_id -> latest RoomStay.date_modified, for reservations with stays
+_versions = None
+_versions_lock = threading.Lock()
+_versions_generation = 0
+
+
+def reservation_version(reservation_id):
+    """Latest date_modified of the reservation's room stays, or None if it has none.
+
+    Every known reservation is loaded with one projection query and kept
+    in memory until sync calls invalidate_reservations().
+    """
+    with _versions_lock:
+        versions = _versions
+        generation = _versions_generation
+    if versions is None:
+        versions = dict(
+            RoomStay.select(RoomStay.reservation_id, fn.MAX(RoomStay.date_modified))
+            .group_by(RoomStay.reservation_id)
+            .tuples()
+        )
+        _store(versions, generation)
+    return versions.get(reservation_id)
+
+
+def _store(versions, generation):
+    global _versions
+    with _versions_lock:
+        # Don't keep a load that raced with a sync's invalidation
+        if generation == _versions_generation:
+            _versions = versions
+
+
+def invalidate_reservations():
+    """Drop the cache after RoomStay rows are written or deleted."""
+    global _versions, _versions_generation
+    with _versions_lock:
+        _versions = None
+        _versions_generation += 1
+
+
+def reservations_generation():
+    """Bumped by every invalidate_reservations(), i.e. every RoomStay write."""
+    with _versions_lock:
+        return _versions_generation
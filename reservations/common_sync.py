@@ -1,11 +1,13 @@
 import os
-import requests
-from datetime import datetime
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 from peewee import AutoField, TextField, IntegerField
-from db import BaseModel, RoomStay
+import upstream
+from db import ID_BATCH_SIZE, BaseModel, RoomStay, write_batches
 from devices import Lock
+from devices.codes import CodeSnapshot
+from devices.executor import SeamExecutor
+from .plan import ACTIVE_STATUSES, code_window, plan_common
 
 
 class CommonCode(BaseModel):
@@ -13,15 +15,17 @@ class CommonCode(BaseModel):
     reservation_id = TextField()
     lock_id = IntegerField()
     seam_access_code_id = TextField(null=True)
+    seam_window = TextField(null=True)  # "starts_at|ends_at" last pushed to Seam
 
 
-def run():
+def run(snapshot=None, seam=None):
+    """Sync common lock codes; `snapshot` and `seam` are shared with the room sync run."""
     load_dotenv()
 
     TZ = ZoneInfo("America/St_Johns")
 
     common_locks = [
-        {"id": d.id, "device": d.device_id, "key": os.environ.get(d.api_key_env)}
+        {"id": d.id, "device": d.device_id, "key": os.environ.get(d.api_key_env), "key_env": d.api_key_env}
         for d in Lock.select().where(Lock.category == "common")
     ]
 
@@ -29,129 +33,153 @@ def run():
         print("No common locks configured")
         return
 
+    if snapshot is None:
+        snapshot = CodeSnapshot()
+    if seam is None:
+        with SeamExecutor() as seam:
+            sync_codes(common_locks, TZ, snapshot, seam)
+    else:
+        sync_codes(common_locks, TZ, snapshot, seam)
+
+
+def sync_codes(common_locks, tz, snapshot, seam):
+    """Plan common code changes from state loaded once, then apply them."""
     # Active reservation IDs from RoomStay
     active = (
         RoomStay.select(RoomStay.reservation_id, RoomStay.res_check_in, RoomStay.res_check_out)
-        .where(RoomStay.res_status.in_(["confirmed", "checked_in"]))
+        .where(RoomStay.res_status.in_(list(ACTIVE_STATUSES)))
     )
     active_res = {}
     for stay in active:
         if stay.reservation_id not in active_res:
             active_res[stay.reservation_id] = stay
+    codes = {(c.reservation_id, c.lock_id): c for c in CommonCode.select()}
+    plan = plan_common(active_res, codes, {l["id"]: l for l in common_locks}, tz)
 
     # Phase 1: Delete codes for reservations no longer active
-    to_delete = CommonCode.select().where(
-        CommonCode.reservation_id.not_in(list(active_res.keys()))
-        & CommonCode.seam_access_code_id.is_null(False)
-    )
-
-    for code in to_delete:
-        lock = next((l for l in common_locks if l["id"] == code.lock_id), None)
-        if not lock:
-            code.delete_instance()
-            continue
-        resp = requests.post(
-            "https://connect.getseam.com/access_codes/delete",
-            headers={"Authorization": f"Bearer {lock['key']}"},
+    jobs = []
+    for code, lock in plan["delete"]:
+        jobs.append(((code, lock), seam.submit(
+            lock["key_env"], upstream.seam.post, "access_codes/delete",
+            key=lock["key"], idempotent=True,
             json={"access_code_id": code.seam_access_code_id}
-        )
+        )))
+
+    removed = list(plan["drop"])
+    for (code, lock), resp in seam.gather(jobs):
         if resp.ok:
             print(f"Deleted common code {code.seam_access_code_id} for reservation {code.reservation_id}")
-            code.delete_instance()
+            snapshot.remove(lock["device"], code.seam_access_code_id)
+            removed.append(code.id)
         else:
             print(f"Failed to delete common code for {code.reservation_id}: {resp.text}")
 
-    # Delete records that never got a code installed
-    deleted = CommonCode.delete().where(
-        CommonCode.reservation_id.not_in(list(active_res.keys()))
-        & CommonCode.seam_access_code_id.is_null()
-    ).execute()
-    if deleted:
-        print(f"Cleaned up {deleted} common code records without Seam codes")
+    for batch in write_batches(removed, ID_BATCH_SIZE):
+        CommonCode.delete().where(CommonCode.id.in_(batch)).execute()
+    if plan["drop"]:
+        print(f"Cleaned up {len(plan['drop'])} stale common code records")
 
     # Phase 2: Create codes for active reservations on each common lock
-    for res_id, stay in active_res.items():
+    pending = plan["create"]
+    snapshot.prefetch(seam, [lock for _, _, lock, _ in pending])
+    adopted_codes = []
+    jobs = []
+    for res_id, stay, lock, existing in pending:
         pin = res_id[-5:]
-        starts_at = datetime.fromisoformat(stay.res_check_in).replace(hour=15, minute=30, tzinfo=TZ).isoformat()
-        ends_at = datetime.fromisoformat(stay.res_check_out).replace(hour=11, minute=30, tzinfo=TZ).isoformat()
-
-        for lock in common_locks:
-            existing = CommonCode.get_or_none(
-                (CommonCode.reservation_id == res_id) & (CommonCode.lock_id == lock["id"])
-            )
-            if existing and existing.seam_access_code_id:
-                continue
-
-            # Check for existing code on the device to adopt
-            resp = requests.post(
-                "https://connect.getseam.com/access_codes/list",
-                headers={"Authorization": f"Bearer {lock['key']}"},
-                json={"device_id": lock["device"]}
-            )
-            adopted = next((c for c in resp.json().get("access_codes", []) if c["code"] == pin), None)
-
-            if adopted:
-                CommonCode.replace(
-                    reservation_id=res_id,
-                    lock_id=lock["id"],
-                    seam_access_code_id=adopted["access_code_id"]
-                ).execute()
-                print(f"Adopted existing common code for reservation {res_id} on lock {lock['id']}")
-                continue
-
-            if datetime.fromisoformat(stay.res_check_out) < datetime.now():
-                continue
-
-            resp = requests.post(
-                "https://connect.getseam.com/access_codes/create",
-                headers={"Authorization": f"Bearer {lock['key']}"},
-                json={
-                    "device_id": lock["device"],
-                    "code": pin,
-                    "name": f"Reservation {res_id}",
-                    "starts_at": starts_at,
-                    "ends_at": ends_at
-                }
-            )
-
-            if resp.ok:
-                code_id = resp.json()["access_code"]["access_code_id"]
-                CommonCode.replace(
-                    reservation_id=res_id,
-                    lock_id=lock["id"],
-                    seam_access_code_id=code_id
-                ).execute()
-                print(f"Created common code for reservation {res_id} on lock {lock['id']}")
-            else:
-                # Create record without code — retry next sync
-                if not existing:
-                    CommonCode.create(reservation_id=res_id, lock_id=lock["id"])
-                print(f"Failed to create common code for {res_id}: {resp.text}")
-
-    # Phase 3: Update time windows for existing codes
-    has_code = CommonCode.select().where(CommonCode.seam_access_code_id.is_null(False))
-
-    for code in has_code:
-        stay = active_res.get(code.reservation_id)
-        if not stay:
-            continue
-        lock = next((l for l in common_locks if l["id"] == code.lock_id), None)
-        if not lock:
+        starts_at, ends_at = code_window(stay.res_check_in, stay.res_check_out, tz)
+
+        # Check for existing code on the device to adopt
+        adopted = snapshot.find_pin(lock["device"], lock["key"], pin)
+
+        if adopted:
+            adopted_codes.append((res_id, lock, adopted["access_code_id"], starts_at, ends_at))
+            print(f"Adopted existing common code for reservation {res_id} on lock {lock['id']}")
             continue
 
-        starts_at = datetime.fromisoformat(stay.res_check_in).replace(hour=15, minute=30, tzinfo=TZ).isoformat()
-        ends_at = datetime.fromisoformat(stay.res_check_out).replace(hour=11, minute=30, tzinfo=TZ).isoformat()
+        jobs.append(((res_id, lock, existing, f"{starts_at}|{ends_at}"), seam.submit(
+            lock["key_env"], upstream.seam.post, "access_codes/create",
+            key=lock["key"],
+            json={
+                "device_id": lock["device"],
+                "code": pin,
+                "name": f"Reservation {res_id}",
+                "starts_at": starts_at,
+                "ends_at": ends_at
+            }
+        )))
+
+    # Adopted codes have no known window, so Phase 3 pushes it
+    saved = [(res_id, lock["id"], code_id, None) for res_id, lock, code_id, _, _ in adopted_codes]
+    failed = []
+    for (res_id, lock, existing, window), resp in seam.gather(jobs):
+        if resp.ok:
+            created = resp.json()["access_code"]
+            snapshot.add(lock["device"], created)
+            saved.append((res_id, lock["id"], created["access_code_id"], window))
+            print(f"Created common code for reservation {res_id} on lock {lock['id']}")
+        else:
+            if not existing:
+                failed.append((res_id, lock["id"]))
+            print(f"Failed to create common code for {res_id}: {resp.text}")
+
+    for batch in write_batches(saved):
+        for res_id, lock_id, code_id, window in batch:
+            CommonCode.replace(
+                reservation_id=res_id,
+                lock_id=lock_id,
+                seam_access_code_id=code_id,
+                seam_window=window
+            ).execute()
+
+    # Create records without code — retry next sync
+    for batch in write_batches(failed):
+        CommonCode.insert_many(
+            [{"reservation_id": res_id, "lock_id": lock_id} for res_id, lock_id in batch]
+        ).execute()
+
+    # Phase 3: Update time windows that differ from the last pushed window
+    changed = plan["update"] + [
+        (CommonCode(reservation_id=res_id, lock_id=lock["id"], seam_access_code_id=code_id), lock, starts_at, ends_at)
+        for res_id, lock, code_id, starts_at, ends_at in adopted_codes
+    ]
+
+    snapshot.prefetch(seam, [lock for _, lock, _, _ in changed])
+    jobs = []
+    gone = []
+    for code, lock, starts_at, ends_at in changed:
+        if not snapshot.has_code(lock["device"], lock["key"], code.seam_access_code_id):
+            print(f"Skipped update for common code {code.reservation_id} — code no longer on device")
+            gone.append(code)
+            continue
 
-        resp = requests.post(
-            "https://connect.getseam.com/access_codes/update",
-            headers={"Authorization": f"Bearer {lock['key']}"},
+        jobs.append(((code, f"{starts_at}|{ends_at}"), seam.submit(
+            lock["key_env"], upstream.seam.post, "access_codes/update",
+            key=lock["key"], idempotent=True,
             json={
                 "access_code_id": code.seam_access_code_id,
                 "starts_at": starts_at,
                 "ends_at": ends_at
             }
-        )
+        )))
+
+    pushed = {}
+    for (code, window), resp in seam.gather(jobs):
         if resp.ok:
+            pushed[(code.reservation_id, code.lock_id)] = window
             print(f"Updated common code dates for reservation {code.reservation_id}")
         else:
             print(f"Failed to update common code for {code.reservation_id}: {resp.text}")
+
+    for batch in write_batches(list(pushed.items())):
+        for (res_id, lock_id), window in batch:
+            CommonCode.update(seam_window=window).where(
+                (CommonCode.reservation_id == res_id) & (CommonCode.lock_id == lock_id)
+            ).execute()
+    # Forget codes deleted from the device so the next run creates new ones
+    for batch in write_batches(gone):
+        for code in batch:
+            CommonCode.update(seam_access_code_id=None, seam_window=None).where(
+                (CommonCode.reservation_id == code.reservation_id) & (CommonCode.lock_id == code.lock_id)
+                & (CommonCode.seam_access_code_id == code.seam_access_code_id)
+            ).execute()
+    print(f"Updated {len(pushed)} common code windows, skipped {plan['unchanged']} unchanged")
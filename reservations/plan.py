@@ -0,0 +1,97 @@
+"""Work out which Seam codes sync should delete, create and update.
+
+Planners take the stored rows, already loaded in one query, and diff them
+against the locks in memory, so planning makes no queries of its own and
+never builds IN lists bounded by SQLite's parameter limit. The sync
+modules then run the plan's Seam calls and write the results.
+"""
+from datetime import datetime
+
+ACTIVE_STATUSES = ("confirmed", "checked_in")
+
+
+def code_window(check_in, check_out, tz):
+    """(starts_at, ends_at) for a stay: 3:30 PM on check-in to 11:30 AM on check-out."""
+    starts_at = datetime.fromisoformat(check_in).replace(hour=15, minute=30, tzinfo=tz).isoformat()
+    ends_at = datetime.fromisoformat(check_out).replace(hour=11, minute=30, tzinfo=tz).isoformat()
+    return starts_at, ends_at
+
+
+def checked_out(check_out, now=None):
+    """Whether a check-out date has passed, so a new code would be useless."""
+    return datetime.fromisoformat(check_out) < (now or datetime.now())
+
+
+def plan_rooms(stays, stale_ids, locks, tz, now=None):
+    """Plan room code changes for `stays`, dropping those in `stale_ids`.
+
+    Returns a dict of:
+      delete: (stay, lock) for stale stays whose code must go first
+      drop:   ids of stale stays without a code, to delete outright
+      create: (stay, lock) for active stays on a lock that have no code,
+              unless their checkout has passed
+      update: (stay, lock, starts_at, ends_at) for codes whose window changed
+    and the count of codes left `unchanged`.
+    """
+    plan = {"delete": [], "drop": [], "create": [], "update": [], "unchanged": 0}
+    for stay in stays:
+        lock = locks.get(stay.room_id)
+        if stay.id in stale_ids:
+            if not stay.seam_access_code_id:
+                plan["drop"].append(stay.id)
+            elif lock:
+                plan["delete"].append((stay, lock))
+            continue
+        if not lock:
+            continue
+        if not stay.seam_access_code_id:
+            if stay.res_status in ACTIVE_STATUSES and not checked_out(stay.room_check_out, now):
+                plan["create"].append((stay, lock))
+            continue
+        starts_at, ends_at = code_window(stay.room_check_in, stay.room_check_out, tz)
+        if stay.seam_window == f"{starts_at}|{ends_at}":
+            plan["unchanged"] += 1
+        else:
+            plan["update"].append((stay, lock, starts_at, ends_at))
+    return plan
+
+
+def plan_common(active, codes, locks, tz, now=None):
+    """Plan common lock code changes.
+
+    `active` maps each active reservation ID to one of its stays, `codes`
+    maps (reservation_id, lock_id) to its CommonCode row and `locks` maps
+    lock ID to lock. Returns a dict of:
+      delete: (code, lock) for codes of reservations no longer active
+      drop:   ids of CommonCode rows to delete outright
+      create: (reservation_id, stay, lock, existing row or None) still needing
+              a code, unless the reservation's checkout has passed
+      update: (code, lock, starts_at, ends_at) for codes whose window changed
+    and the count of codes left `unchanged`.
+    """
+    plan = {"delete": [], "drop": [], "create": [], "update": [], "unchanged": 0}
+    for (res_id, lock_id), code in codes.items():
+        lock = locks.get(lock_id)
+        stay = active.get(res_id)
+        if stay is None:
+            if code.seam_access_code_id and lock:
+                plan["delete"].append((code, lock))
+            else:
+                plan["drop"].append(code.id)
+            continue
+        if not (code.seam_access_code_id and lock):
+            continue
+        starts_at, ends_at = code_window(stay.res_check_in, stay.res_check_out, tz)
+        if code.seam_window == f"{starts_at}|{ends_at}":
+            plan["unchanged"] += 1
+        else:
+            plan["update"].append((code, lock, starts_at, ends_at))
+
+    for res_id, stay in active.items():
+        if checked_out(stay.res_check_out, now):
+            continue
+        for lock in locks.values():
+            existing = codes.get((res_id, lock["id"]))
+            if not (existing and existing.seam_access_code_id):
+                plan["create"].append((res_id, stay, lock, existing))
+    return plan
@@ -1,141 +1,430 @@
 import os
-import requests
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta, datetime
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
-from db import RoomStay
+from peewee import TextField, chunked
+import metrics
+import upstream
+from db import ID_BATCH_SIZE, BaseModel, RoomStay, ReservationPayload, write_batches
 from devices import Lock
+from devices.codes import CodeSnapshot
+from devices.executor import SeamExecutor
+from .cache import invalidate_reservations
+from .plan import code_window, plan_rooms
 
+# How long incremental syncs may run before a full-window sync is forced.
+# Only full syncs can notice reservations that dropped out of the window.
+FULL_SYNC_INTERVAL = timedelta(hours=6)
 
-def run():
-    load_dotenv()
+# Rows per INSERT; 14 columns x 50 rows stays under SQLite's 999 variable limit.
+UPSERT_BATCH_SIZE = 50
 
-    API_KEY = os.environ.get("CLOUDBEDS_API_KEY")
-    PROPERTY_ID = os.environ.get("CLOUDBEDS_PROPERTY_ID")
-    ROOM_TYPE_FILTER = os.environ.get("ROOM_TYPE_ID")
+# getReservations page size, and reservation IDs per getReservationsWithRateDetails
+# call (keeps the URL short); up to FETCH_WORKERS detail calls run at once.
+PAGE_SIZE = 100
+DETAIL_CHUNK_SIZE = 25
+FETCH_WORKERS = 4
 
-    LOCKS = {
-        d.room_id: {"device": d.device_id, "key": os.environ.get(d.api_key_env)}
-        for d in Lock.select()
-    }
-    DAYS_BACK = (date.today() - timedelta(days=7)).isoformat()
-    DAYS_AHEAD = (date.today() + timedelta(days=7)).isoformat()
-    TZ = ZoneInfo("America/St_Johns")
-
-    # Step 1: Get reservation IDs
-    res_list = requests.get(
-        "https://api.cloudbeds.com/api/v1.2/getReservations",
-        headers={"Authorization": f"Bearer {API_KEY}"},
-        params={
-            "propertyID": PROPERTY_ID,
-            "roomTypeID": ROOM_TYPE_FILTER,
-            "checkInFrom": DAYS_BACK,
-            "checkInTo": DAYS_AHEAD,
-        }
-    ).json()
+TZ = ZoneInfo("America/St_Johns")
+
+# Full and per-reservation syncs take turns, so two runs never create a
+# code for the same stay
+sync_lock = threading.Lock()
+
+
+class SyncState(BaseModel):
+    key = TextField(primary_key=True)
+    value = TextField()
+
+
+def get_state(key):
+    row = SyncState.get_or_none(SyncState.key == key)
+    return row.value if row else None
 
-    res_ids = ",".join([r["reservationID"] for r in res_list["data"]]) or "null"
-    print(f"Found {len(res_list['data'])} reservations")
 
-    # Step 2: Get full details
-    response = requests.get(
-        "https://api.cloudbeds.com/api/v1.2/getReservationsWithRateDetails",
-        headers={"Authorization": f"Bearer {API_KEY}"},
+def set_state(key, value):
+    SyncState.replace(key=key, value=value).execute()
+
+
+def incremental_since(watermark_key, full_key, interval, full=False):
+    """(watermark, incremental) for a watermarked refresh.
+
+    Incremental unless `full` is asked for, there is no watermark yet, or
+    the last full run (stored under `full_key`) is older than `interval`.
+    """
+    watermark = get_state(watermark_key)
+    last_full = get_state(full_key)
+    incremental = bool(
+        not full and watermark and last_full
+        and datetime.now() - datetime.fromisoformat(last_full) < interval
+    )
+    return watermark, incremental
+
+
+def iter_reservation_rows(params):
+    """Walk every page of getReservations, yielding its summary rows."""
+    page = 1
+    while True:
+        data = upstream.cloudbeds.get(
+            "getReservations",
+            params={**params, "pageNumber": page, "pageSize": PAGE_SIZE}
+        ).json()["data"]
+        yield from data
+        if len(data) < PAGE_SIZE:
+            return
+        page += 1
+
+
+def iter_reservation_ids(params):
+    """Walk every page of getReservations, yielding reservation IDs."""
+    for r in iter_reservation_rows(params):
+        yield r["reservationID"]
+
+
+def fetch_details(reservation_ids):
+    return upstream.cloudbeds.get(
+        "getReservationsWithRateDetails",
         params={
-            "propertyID": PROPERTY_ID,
-            "reservationID": res_ids,
+            "propertyID": os.environ.get("CLOUDBEDS_PROPERTY_ID"),
+            "reservationID": ",".join(reservation_ids),
         }
-    )
+    ).json()["data"]
 
-    data = response.json()
-    api_ids = []
-
-    for res in data["data"]:
-        for room in res["rooms"]:
-            room_id = room.get("roomID")
-            room_name = room.get("roomName")
-            stay_id = f"{res['reservationID']}_{room_id}"
-            api_ids.append(stay_id)
-            existing = RoomStay.get_or_none(RoomStay.id == stay_id)
-            RoomStay.replace(
-                id=stay_id,
-                reservation_id=res["reservationID"],
-                room_id=room_id,
-                room_name=room_name,
-                guest_name=res["guestName"],
-                room_status=room["roomStatus"],
-                room_check_in=room["roomCheckIn"],
-                room_check_out=room["roomCheckOut"],
-                res_check_in=res["reservationCheckIn"],
-                res_check_out=res["reservationCheckOut"],
-                res_status=res["status"],
-                balance=res["balance"],
-                date_modified=res["dateModified"],
-                data=res,
-                seam_access_code_id=existing.seam_access_code_id if existing else None
+
+def iter_reservations(params):
+    """Yield full reservation details for every reservation matching `params`."""
+    return iter_details(iter_reservation_ids(params))
+
+
+def iter_details(reservation_ids):
+    """Yield full reservation details for `reservation_ids`.
+
+    IDs are fetched in DETAIL_CHUNK_SIZE chunks, up to FETCH_WORKERS at a
+    time, and yielded as each chunk completes so the caller never holds
+    the whole window in memory.
+    """
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="cloudbeds") as pool:
+        in_flight = deque()
+        for ids in chunked(reservation_ids, DETAIL_CHUNK_SIZE):
+            in_flight.append(pool.submit(fetch_details, ids))
+            if len(in_flight) >= FETCH_WORKERS:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+
+def upsert_stays(rows, payloads=()):
+    """Insert or update room stays and their reservations' payloads;
+    returns the room stay count.
+
+    Code columns are left as they are on existing stays: Seam events may
+    have changed them since the rows were built.
+    """
+    with metrics.phase("upsert"):
+        for batch in write_batches(rows, UPSERT_BATCH_SIZE):
+            RoomStay.insert_many(batch).on_conflict(
+                conflict_target=[RoomStay.id],
+                preserve=[
+                    f for f in RoomStay._meta.sorted_fields
+                    if f.name not in ("id", "seam_access_code_id", "seam_window")
+                ]
             ).execute()
+        for batch in write_batches(payloads, UPSERT_BATCH_SIZE):
+            ReservationPayload.replace_many(batch).execute()
+        if rows:
+            invalidate_reservations()
+    metrics.count(stays_saved=len(rows))
+    return len(rows)
 
-    print(f"Saved {len(api_ids)} room stays")
 
-    # Delete Seam access codes for records being removed
-    to_delete = RoomStay.select().where(
-        (RoomStay.id.not_in(api_ids)) &
-        (RoomStay.seam_access_code_id.is_null(False))
-    )
+def room_locks():
+    return {
+        d.room_id: {"device": d.device_id, "key": os.environ.get(d.api_key_env), "key_env": d.api_key_env}
+        for d in Lock.select()
+    }
+
 
-    for stay in to_delete:
-        lock = LOCKS.get(stay.room_id)
-        if not lock:
+def sync_window():
+    """Check-in dates (from, to) that sync keeps room stays for."""
+    return (date.today() - timedelta(days=7)).isoformat(), (date.today() + timedelta(days=7)).isoformat()
+
+
+def stay_rows(res, stored):
+    """RoomStay rows for a reservation's rooms, and every room's stay id.
+
+    Rooms whose stored date_modified (from `stored`, see stored_stays)
+    matches the reservation's are left out.
+    """
+    rows = []
+    stay_ids = []
+    for room in res["rooms"]:
+        room_id = room.get("roomID")
+        stay_id = f"{res['reservationID']}_{room_id}"
+        stay_ids.append(stay_id)
+        date_modified, _ = stored.get(stay_id, (None, None))
+        if date_modified == res["dateModified"]:
             continue
-        resp = requests.post(
-            "https://connect.getseam.com/access_codes/delete",
-            headers={"Authorization": f"Bearer {lock['key']}"},
-            json={"access_code_id": stay.seam_access_code_id}
+        rows.append(dict(
+            id=stay_id,
+            reservation_id=res["reservationID"],
+            room_id=room_id,
+            room_name=room.get("roomName"),
+            guest_name=res["guestName"],
+            room_status=room["roomStatus"],
+            room_check_in=room["roomCheckIn"],
+            room_check_out=room["roomCheckOut"],
+            res_check_in=res["reservationCheckIn"],
+            res_check_out=res["reservationCheckOut"],
+            res_status=res["status"],
+            balance=res["balance"],
+            date_modified=res["dateModified"],
+        ))
+    return rows, stay_ids
+
+
+def payload_row(res):
+    return dict(
+        reservation_id=res["reservationID"],
+        date_modified=res["dateModified"],
+        blob=ReservationPayload.encode(res),
+    )
+
+
+def stored_stays(where=True):
+    """Stay id -> (date_modified, reservation id) for stored stays."""
+    return {
+        s.id: (s.date_modified, s.reservation_id)
+        for s in RoomStay.select(RoomStay.id, RoomStay.date_modified, RoomStay.reservation_id).where(where)
+    }
+
+
+def apply_codes(locks, stale_ids, scope=None, progress=None):
+    """Run the room and common code phases, then drop orphaned payloads."""
+    # Each device's code list is fetched at most once, shared with common sync
+    snapshot = CodeSnapshot()
+    seam = SeamExecutor()
+    try:
+        if progress:
+            progress("syncing room codes")
+        # The dashboard ETag and guest page versions key on this, so only
+        # bump it when stays actually changed
+        if sync_codes(locks, TZ, stale_ids, snapshot, seam, scope):
+            invalidate_reservations()
+        with metrics.phase("delete"):
+            ReservationPayload.delete().where(
+                ReservationPayload.reservation_id.not_in(RoomStay.select(RoomStay.reservation_id))
+            ).execute()
+
+        # Sync common lock codes
+        from .common_sync import run as run_common_sync
+        if progress:
+            progress("syncing common codes")
+        with metrics.phase("common"):
+            run_common_sync(snapshot, seam)
+    finally:
+        seam.shutdown()
+
+
+def run(full=False, progress=None):
+    """Sync room stays from Cloudbeds and their Seam codes.
+
+    Unless `full` is set, only reservations modified since the last stored
+    dateModified watermark are fetched. A full-window sync still runs when
+    there is no watermark yet or the last one is older than FULL_SYNC_INTERVAL.
+    `progress`, if given, is called with the name of each phase as it starts.
+    """
+    load_dotenv()
+
+    if progress is None:
+        progress = lambda phase: None
+
+    PROPERTY_ID = os.environ.get("CLOUDBEDS_PROPERTY_ID")
+    ROOM_TYPE_FILTER = os.environ.get("ROOM_TYPE_ID")
+    DAYS_BACK, DAYS_AHEAD = sync_window()
+
+    with sync_lock:
+        LOCKS = room_locks()
+        watermark, incremental = incremental_since(
+            "reservations_modified", "reservations_full_sync", FULL_SYNC_INTERVAL, full
         )
+        with metrics.recording("incremental" if incremental else "full"):
+            started = datetime.now()
+
+            # Steps 1 & 2: Stream reservation details page by page, chunk by chunk
+            progress("fetching reservations")
+            params = {
+                "propertyID": PROPERTY_ID,
+                "roomTypeID": ROOM_TYPE_FILTER,
+                "checkInFrom": DAYS_BACK,
+                "checkInTo": DAYS_AHEAD,
+            }
+            if incremental:
+                params["modifiedFrom"] = watermark
+
+            stored = stored_stays()
+            rows = []
+            payloads = {}
+            saved = 0
+            api_ids = []
+            fetched_res_ids = []
+            new_watermark = watermark or ""
+            unchanged = 0
+
+            for res in metrics.timed(iter_reservations(params), "fetch"):
+                fetched_res_ids.append(res["reservationID"])
+                new_watermark = max(new_watermark, res["dateModified"])
+                res_rows, stay_ids = stay_rows(res, stored)
+                api_ids.extend(stay_ids)
+                unchanged += len(stay_ids) - len(res_rows)
+                if res_rows:
+                    rows.extend(res_rows)
+                    payloads[res["reservationID"]] = payload_row(res)
+                # Write each full batch as it arrives rather than holding every payload
+                if len(rows) >= UPSERT_BATCH_SIZE:
+                    saved += upsert_stays(rows, list(payloads.values()))
+                    rows, payloads = [], {}
+            saved += upsert_stays(rows, list(payloads.values()))
+
+            if incremental:
+                print(f"Found {len(fetched_res_ids)} reservations modified since {watermark}")
+            else:
+                print(f"Found {len(fetched_res_ids)} reservations")
+            print(f"Saved {saved} room stays ({unchanged} unchanged)")
+            metrics.count(reservations=len(fetched_res_ids), stays_unchanged=unchanged)
+
+            if new_watermark:
+                set_state("reservations_modified", new_watermark)
+            if not incremental:
+                set_state("reservations_full_sync", started.isoformat())
+
+            # Records being removed: anything outside the window on a full sync, but
+            # only rooms dropped from a fetched reservation on an incremental one
+            api_ids = set(api_ids)
+            fetched_res_ids = set(fetched_res_ids)
+            stale_ids = {
+                stay_id for stay_id, (_, res_id) in stored.items()
+                if stay_id not in api_ids and (not incremental or res_id in fetched_res_ids)
+            }
+
+            apply_codes(LOCKS, stale_ids, progress=progress)
+
+
+def sync_reservations(reservation_ids):
+    """Sync just these reservations' room stays and codes, e.g. from webhooks.
+
+    Reservations Cloudbeds no longer returns, or that fall outside the
+    sync window or room type, lose their stays and codes just as a full
+    sync would drop them.
+    """
+    load_dotenv()
+    room_type = os.environ.get("ROOM_TYPE_ID")
+    window_from, window_to = sync_window()
+    reservation_ids = list(reservation_ids)
+
+    with sync_lock, metrics.recording("targeted"):
+        locks = room_locks()
+        in_scope = RoomStay.reservation_id.in_(reservation_ids)
+        stored = stored_stays(in_scope)
+        rows, payloads, api_ids = [], [], []
+        for ids in chunked(reservation_ids, DETAIL_CHUNK_SIZE):
+            with metrics.phase("fetch"):
+                fetched = fetch_details(ids)
+            for res in fetched:
+                if not window_from <= res["reservationCheckIn"] <= window_to:
+                    continue
+                if room_type and not any(str(r.get("roomTypeID")) == room_type for r in res["rooms"]):
+                    continue
+                res_rows, stay_ids = stay_rows(res, stored)
+                api_ids.extend(stay_ids)
+                if res_rows:
+                    rows.extend(res_rows)
+                    payloads.append(payload_row(res))
+        saved = upsert_stays(rows, payloads)
+        print(f"Saved {saved} room stays for {len(reservation_ids)} reservations")
+        metrics.count(reservations=len(reservation_ids))
+
+        apply_codes(locks, stored.keys() - set(api_ids), scope=in_scope)
+
+
+def sync_codes(locks, tz, stale_ids, snapshot, seam, scope=None):
+    """Delete, create and update room Seam codes, running the calls concurrently.
+
+    The stays are loaded once and planned in memory (see plan_rooms);
+    `stale_ids` are the stays to remove. `scope`, if given, limits the
+    stays considered to matching rows. Returns the number of stays
+    written or deleted.
+    """
+    with metrics.phase("plan"):
+        stays = RoomStay.select()
+        if scope is not None:
+            stays = stays.where(scope)
+        plan = plan_rooms(stays, stale_ids, locks, tz)
+    with metrics.phase("delete"):
+        deleted = delete_stale(plan, snapshot, seam)
+    with metrics.phase("create"):
+        created, adopted = create_codes(plan, tz, snapshot, seam)
+    with metrics.phase("update"):
+        updated, cleared = update_codes(plan["update"] + adopted, plan["unchanged"], snapshot, seam)
+    metrics.count(codes_deleted=deleted, codes_created=created, codes_updated=updated)
+    return deleted + len(plan["drop"]) + created + len(adopted) + updated + cleared
+
+
+def delete_stale(plan, snapshot, seam):
+    """Delete stale room stays, removing their Seam codes first; returns codes deleted."""
+    jobs = []
+    for stay, lock in plan["delete"]:
+        jobs.append(((stay, lock), seam.submit(
+            lock["key_env"], upstream.seam.post, "access_codes/delete",
+            key=lock["key"], idempotent=True,
+            json={"access_code_id": stay.seam_access_code_id}
+        )))
+
+    removed = []
+    for (stay, lock), resp in seam.gather(jobs):
         if resp.ok:
             print(f"Deleted Seam code for {stay.guest_name} on {stay.room_name}")
-            stay.delete_instance()
+            snapshot.remove(lock["device"], stay.seam_access_code_id)
+            removed.append(stay.id)
         else:
             print(f"Failed to delete Seam code for {stay.guest_name}: {resp.text}")
 
-    # Delete records that never had a Seam code
-    deleted = RoomStay.delete().where(
-        (RoomStay.id.not_in(api_ids)) &
-        (RoomStay.seam_access_code_id.is_null())
-    ).execute()
-    print(f"Deleted {deleted} old room stays without codes")
-
-    # Create Seam access codes for confirmed reservations
-    needs_code = RoomStay.select().where(
-        (RoomStay.res_status.in_(["confirmed", "checked_in"])) &
-        (RoomStay.seam_access_code_id.is_null()) &
-        (RoomStay.room_id.in_(list(LOCKS.keys())))
-    )
+    # Stays that never had a Seam code go along with those whose code is gone
+    for batch in write_batches(removed + plan["drop"], ID_BATCH_SIZE):
+        RoomStay.delete().where(RoomStay.id.in_(batch)).execute()
+    print(f"Deleted {len(plan['drop'])} old room stays without codes")
+    return len(removed)
+
+
+def create_codes(plan, tz, snapshot, seam):
+    """Create or adopt codes for confirmed stays without one.
 
-    for stay in needs_code:
-        lock = LOCKS[stay.room_id]
+    Returns the number created, and adopted codes as update entries:
+    their window on the device is unknown, so the update phase pushes it.
+    """
+    snapshot.prefetch(seam, [lock for _, lock in plan["create"]])
+    assigned = {}
+    adopted = []
+    jobs = []
+    for stay, lock in plan["create"]:
         pin = stay.reservation_id[-5:]
-        starts_at = datetime.fromisoformat(stay.room_check_in).replace(hour=15, minute=30, tzinfo=TZ).isoformat()
-        ends_at = datetime.fromisoformat(stay.room_check_out).replace(hour=11, minute=30, tzinfo=TZ).isoformat()
+        starts_at, ends_at = code_window(stay.room_check_in, stay.room_check_out, tz)
 
         # Check for existing code to adopt
-        resp = requests.post("https://connect.getseam.com/access_codes/list",
-            headers={"Authorization": f"Bearer {lock['key']}"}, json={"device_id": lock["device"]})
-        existing = next((c for c in resp.json().get("access_codes", []) if c["code"] == pin), None)
+        existing = snapshot.find_pin(lock["device"], lock["key"], pin)
 
         if existing:
+            assigned[stay.id] = (existing["access_code_id"], None)
             stay.seam_access_code_id = existing["access_code_id"]
-            stay.save()
+            adopted.append((stay, lock, starts_at, ends_at))
             print(f"Adopted existing code for {stay.guest_name} on {stay.room_name}")
             continue
 
-        if datetime.fromisoformat(stay.room_check_out) < datetime.now():
-            print(f"Skipped {stay.guest_name} on {stay.room_name} — checkout has passed ({stay.room_check_out})")
-            continue
-
-        resp = requests.post(
-            "https://connect.getseam.com/access_codes/create",
-            headers={"Authorization": f"Bearer {lock['key']}"},
+        jobs.append(((stay, lock, f"{starts_at}|{ends_at}"), seam.submit(
+            lock["key_env"], upstream.seam.post, "access_codes/create",
+            key=lock["key"],
             json={
                 "device_id": lock["device"],
                 "code": pin,
@@ -143,40 +432,68 @@ def run():
                 "starts_at": starts_at,
                 "ends_at": ends_at
             }
-        )
+        )))
 
+    created = 0
+    for (stay, lock, window), resp in seam.gather(jobs):
         if resp.ok:
-            code_id = resp.json()["access_code"]["access_code_id"]
-            stay.seam_access_code_id = code_id
-            stay.save()
+            created += 1
+            code = resp.json()["access_code"]
+            snapshot.add(lock["device"], code)
+            assigned[stay.id] = (code["access_code_id"], window)
             print(f"Created access code for {stay.guest_name} on {stay.room_name}")
         else:
             print(f"Failed to create code for {stay.guest_name}: {resp.text}")
 
-    # Update Seam access codes with current dates
-    has_code = RoomStay.select().where(RoomStay.seam_access_code_id.is_null(False))
+    for batch in write_batches(list(assigned.items())):
+        for stay_id, (code_id, window) in batch:
+            RoomStay.update(
+                seam_access_code_id=code_id, seam_window=window
+            ).where(RoomStay.id == stay_id).execute()
+    return created, adopted
 
-    for stay in has_code:
-        lock = LOCKS.get(stay.room_id)
-        if not lock:
+
+def update_codes(changed, unchanged, snapshot, seam):
+    """Push windows that differ from the last one pushed.
+
+    Returns the codes updated, and how many stays were cleared because
+    their code is no longer on the device.
+    """
+    snapshot.prefetch(seam, [lock for _, lock, _, _ in changed])
+    jobs = []
+    gone = []
+    for stay, lock, starts_at, ends_at in changed:
+        if not snapshot.has_code(lock["device"], lock["key"], stay.seam_access_code_id):
+            print(f"Skipped update for {stay.guest_name} — code no longer on device")
+            gone.append((stay.id, stay.seam_access_code_id))
             continue
-        starts_at = datetime.fromisoformat(stay.room_check_in).replace(hour=15, minute=30, tzinfo=TZ).isoformat()
-        ends_at = datetime.fromisoformat(stay.room_check_out).replace(hour=11, minute=30, tzinfo=TZ).isoformat()
 
-        resp = requests.post(
-            "https://connect.getseam.com/access_codes/update",
-            headers={"Authorization": f"Bearer {lock['key']}"},
+        jobs.append(((stay, f"{starts_at}|{ends_at}"), seam.submit(
+            lock["key_env"], upstream.seam.post, "access_codes/update",
+            key=lock["key"], idempotent=True,
             json={
                 "access_code_id": stay.seam_access_code_id,
                 "starts_at": starts_at,
                 "ends_at": ends_at
             }
-        )
+        )))
+
+    pushed = {}
+    for (stay, window), resp in seam.gather(jobs):
         if resp.ok:
+            pushed[stay.id] = window
             print(f"Updated code dates for {stay.guest_name}")
         else:
             print(f"Failed to update code for {stay.guest_name}: {resp.text}")
 
-    # Sync common lock codes
-    from .common_sync import run as run_common_sync
-    run_common_sync()
+    for batch in write_batches(list(pushed.items())):
+        for stay_id, window in batch:
+            RoomStay.update(seam_window=window).where(RoomStay.id == stay_id).execute()
+    # Forget codes deleted from the device so the next run creates new ones
+    for batch in write_batches(gone):
+        for stay_id, code_id in batch:
+            RoomStay.update(seam_access_code_id=None, seam_window=None).where(
+                (RoomStay.id == stay_id) & (RoomStay.seam_access_code_id == code_id)
+            ).execute()
+    print(f"Updated {len(pushed)} code windows, skipped {unchanged} unchanged")
+    return len(pushed), len(gone)
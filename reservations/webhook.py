@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta, timezone
+from peewee import TextField, IntegerField, DateTimeField
+import metrics
+from db import BaseModel
+from worker import Worker
+from .sync import sync_reservations
+
+# Events for a reservation within this many seconds of the first share one sync
+COALESCE_SECONDS = 5
+# Reservations per targeted sync; failed ones are retried up to MAX_ATTEMPTS,
+# then dropped with an error (counted in reservation_sync_abandoned_total)
+SYNC_BATCH_SIZE = 25
+MAX_ATTEMPTS = 5
+
+
+class SyncRequest(BaseModel):
+    """Reservations waiting for a targeted sync, one row per reservation."""
+    reservation_id = TextField(primary_key=True)
+    event = TextField()
+    requested_at = DateTimeField()
+    due_at = DateTimeField()
+    attempts = IntegerField(default=0)
+    last_error = TextField(null=True)
+
+
+def enqueue(reservation_id, event):
+    """Queue a sync of the reservation, or fold into the one already queued.
+
+    A queued request keeps its due time, so a burst of events can't push
+    the sync back indefinitely.
+    """
+    now = datetime.now(timezone.utc)
+    SyncRequest.insert(
+        reservation_id=reservation_id,
+        event=event,
+        requested_at=now,
+        due_at=now + timedelta(seconds=COALESCE_SECONDS),
+    ).on_conflict(
+        conflict_target=[SyncRequest.reservation_id],
+        preserve=[SyncRequest.event, SyncRequest.requested_at],
+    ).execute()
+
+
+def sync_batch(due):
+    """Sync the batch, halving it on failure so one bad reservation can't
+    fail the rest; returns (request, error) for each that still failed."""
+    try:
+        sync_reservations([r.reservation_id for r in due])
+        return []
+    except Exception as e:
+        if len(due) == 1:
+            return [(due[0], e)]
+        mid = len(due) // 2
+        return sync_batch(due[:mid]) + sync_batch(due[mid:])
+
+
+def drain(progress=None):
+    """Sync queued reservations that are due, until none are.
+
+    Requests not yet due are left for the next trigger or interval run.
+    """
+    while True:
+        now = datetime.now(timezone.utc)
+        due = list(
+            SyncRequest.select().where(SyncRequest.due_at <= now)
+            .order_by(SyncRequest.due_at).limit(SYNC_BATCH_SIZE)
+        )
+        if not due:
+            return
+
+        if progress:
+            progress(f"syncing {len(due)} reservations")
+        failed = sync_batch(due)
+        failed_ids = {r.reservation_id for r, _ in failed}
+        for r, e in failed:
+            attempts = r.attempts + 1
+            if attempts >= MAX_ATTEMPTS:
+                # Give up; the next full sync still picks the reservation up
+                print(f"ERROR: gave up syncing reservation {r.reservation_id} after {attempts} attempts: {e}")
+                metrics.inc("reservation_sync_abandoned_total", {})
+                SyncRequest.delete().where(
+                    (SyncRequest.reservation_id == r.reservation_id)
+                    & (SyncRequest.requested_at == r.requested_at)
+                ).execute()
+                continue
+            print(f"Targeted sync of reservation {r.reservation_id} failed: {e}")
+            # Retry with backoff; anything re-requested meanwhile keeps its row
+            SyncRequest.update(
+                attempts=attempts,
+                last_error=str(e),
+                due_at=now + timedelta(seconds=COALESCE_SECONDS * 2 ** attempts),
+            ).where(SyncRequest.reservation_id == r.reservation_id).execute()
+        # Only clear requests that weren't renewed while the sync ran
+        for r in due:
+            if r.reservation_id in failed_ids:
+                continue
+            SyncRequest.delete().where(
+                (SyncRequest.reservation_id == r.reservation_id)
+                & (SyncRequest.requested_at == r.requested_at)
+            ).execute()
+
+
+# Triggered by each webhook; the interval picks up requests as they come due
+reservation_worker = Worker("reservation-sync", drain, timedelta(seconds=COALESCE_SECONDS))
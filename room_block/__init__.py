@@ -1,43 +1,61 @@
 import os
 import random
-import requests
 from flask import Blueprint, request, jsonify
 from peewee import AutoField, TextField, IntegerField
+import upstream
 from db import BaseModel
 from devices import Lock
-from datetime import datetime
+from devices.executor import SeamExecutor, bucket_for
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
+from worker import Worker
 
 load_dotenv()
 
 room_block_bp = Blueprint('room_block', __name__, url_prefix='/room-block')
 
+# Webhooks arriving within this long of each other share one reconcile,
+# which waits at most RECONCILE_MAX_DELAY after the first
+RECONCILE_QUIET = timedelta(seconds=10)
+RECONCILE_MAX_DELAY = timedelta(minutes=1)
 
-def reconcile():
-    api_key = os.environ.get("CLOUDBEDS_API_KEY")
+
+def reconcile(progress=None):
+    """Delete Seam codes whose room block no longer exists in Cloudbeds."""
     property_id = os.environ.get("CLOUDBEDS_PROPERTY_ID")
-    resp = requests.get(
-        "https://api.cloudbeds.com/api/v1.2/getRoomBlocks",
-        headers={"Authorization": f"Bearer {api_key}"},
-        params={"propertyID": property_id}
-    )
+    resp = upstream.cloudbeds.get("getRoomBlocks", params={"propertyID": property_id})
     active_ids = {str(b["roomBlockID"]) for b in resp.json().get("data", {}).get("roomBlocks", [])}
 
-    for record in RoomBlockCode.select():
-        if record.room_block_id in active_ids:
-            continue
-        lock = Lock.get_or_none(Lock.id == record.lock_id)
-        if lock:
-            seam_key = os.environ.get(lock.api_key_env)
-            requests.post(
-                "https://connect.getseam.com/access_codes/delete",
-                headers={"Authorization": f"Bearer {seam_key}"},
-                json={"access_code_id": record.seam_code_id}
-            )
-        record.delete_instance()
+    locks = {l.id: l for l in Lock.select()}
+    orphaned = []
+    with SeamExecutor() as seam:
+        jobs = []
+        for record in RoomBlockCode.select():
+            if record.room_block_id in active_ids:
+                continue
+            orphaned.append(record)
+            lock = locks.get(record.lock_id)
+            if lock:
+                seam_key = os.environ.get(lock.api_key_env)
+                jobs.append((record, seam.submit(
+                    lock.api_key_env, upstream.seam.post, "access_codes/delete",
+                    key=seam_key, idempotent=True,
+                    json={"access_code_id": record.seam_code_id}
+                )))
+        for _ in seam.gather(jobs):
+            pass
+
+    if orphaned:
+        RoomBlockCode.delete().where(RoomBlockCode.id.in_([r.id for r in orphaned])).execute()
+    for record in orphaned:
         print(f"Reconciled: deleted orphaned room block {record.room_block_id}")
 
+
+reconcile_worker = Worker(
+    "room-block-reconcile", reconcile, debounce=RECONCILE_QUIET, max_delay=RECONCILE_MAX_DELAY
+)
+
 TZ = ZoneInfo("America/St_Johns")
 
 
@@ -67,9 +85,10 @@ def created():
     ends_at = datetime.fromisoformat(data["endDate"]).replace(hour=23, minute=59, tzinfo=TZ).isoformat()
 
     seam_key = os.environ.get(lock.api_key_env)
-    resp = requests.post(
-        "https://connect.getseam.com/access_codes/create",
-        headers={"Authorization": f"Bearer {seam_key}"},
+    bucket_for(lock.api_key_env).acquire()
+    resp = upstream.seam.post(
+        "access_codes/create",
+        key=seam_key,
         json={
             "device_id": lock.device_id,
             "code": pin,
@@ -86,11 +105,9 @@ def created():
         lock_id=lock.id
     )
 
-    api_key = os.environ.get("CLOUDBEDS_API_KEY")
     property_id = os.environ.get("CLOUDBEDS_PROPERTY_ID")
-    requests.put(
-        "https://api.cloudbeds.com/api/v1.2/putRoomBlock",
-        headers={"Authorization": f"Bearer {api_key}"},
+    upstream.cloudbeds.put(
+        "putRoomBlock",
         json={
             "propertyID": property_id,
             "roomBlockID": data["roomBlockID"],
@@ -98,8 +115,8 @@ def created():
         }
     )
 
-    reconcile()
-    return jsonify({"success": True, "code": pin}), 201
+    reconcile_worker.trigger()
+    return jsonify({"success": True, "code": pin}), 202
 
 
 @room_block_bp.route('/deleted', methods=['POST'])
@@ -113,15 +130,16 @@ def deleted():
     lock = Lock.get_or_none(Lock.id == record.lock_id)
     if lock:
         seam_key = os.environ.get(lock.api_key_env)
-        requests.post(
-            "https://connect.getseam.com/access_codes/delete",
-            headers={"Authorization": f"Bearer {seam_key}"},
+        bucket_for(lock.api_key_env).acquire()
+        upstream.seam.post(
+            "access_codes/delete",
+            key=seam_key, idempotent=True,
             json={"access_code_id": record.seam_code_id}
         )
 
     record.delete_instance()
-    reconcile()
-    return jsonify({"success": True}), 200
+    reconcile_worker.trigger()
+    return jsonify({"success": True}), 202
 
 
 @room_block_bp.route('/details-changed', methods=['POST'])
@@ -138,19 +156,18 @@ def details_changed():
     lock = Lock.get_or_none(Lock.id == record.lock_id)
     if lock:
         seam_key = os.environ.get(lock.api_key_env)
-        requests.post(
-            "https://connect.getseam.com/access_codes/delete",
-            headers={"Authorization": f"Bearer {seam_key}"},
+        bucket_for(lock.api_key_env).acquire()
+        upstream.seam.post(
+            "access_codes/delete",
+            key=seam_key, idempotent=True,
             json={"access_code_id": record.seam_code_id}
         )
 
     record.delete_instance()
 
-    api_key = os.environ.get("CLOUDBEDS_API_KEY")
     property_id = os.environ.get("CLOUDBEDS_PROPERTY_ID")
-    requests.put(
-        "https://api.cloudbeds.com/api/v1.2/putRoomBlock",
-        headers={"Authorization": f"Bearer {api_key}"},
+    upstream.cloudbeds.put(
+        "putRoomBlock",
         json={
             "propertyID": property_id,
             "roomBlockID": data["roomBlockID"],
@@ -158,5 +175,11 @@ def details_changed():
         }
     )
 
-    reconcile()
-    return jsonify({"success": True}), 200
+    reconcile_worker.trigger()
+    return jsonify({"success": True}), 202
+
+
+@room_block_bp.route('/reconcile/status')
+def reconcile_status():
+    """Reconcile runs, and how many webhooks the last one merged."""
+    return jsonify(reconcile_worker.status())
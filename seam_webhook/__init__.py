@@ -0,0 +1,63 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from flask import Blueprint, request, jsonify
+from dotenv import load_dotenv
+from .events import SeamEvent, event_worker
+
+load_dotenv()
+
+# Reject deliveries signed longer ago than this (seconds), against replays
+SIGNATURE_TOLERANCE = 300
+
+seam_bp = Blueprint('seam_webhook', __name__, url_prefix='/seam')
+
+
+def verify(body, headers):
+    """Check a Seam (Svix) webhook signature against SEAM_WEBHOOK_SECRET."""
+    secret = os.environ.get("SEAM_WEBHOOK_SECRET")
+    msg_id = headers.get("svix-id")
+    timestamp = headers.get("svix-timestamp")
+    signatures = headers.get("svix-signature")
+    if not (secret and msg_id and timestamp and signatures):
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > SIGNATURE_TOLERANCE:
+            return False
+        key = base64.b64decode(secret.removeprefix("whsec_"))
+    except ValueError:
+        return False
+    signed = f"{msg_id}.{timestamp}.".encode() + body
+    expected = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+    # Header is a space-separated list of "v1,<signature>"
+    return any(
+        hmac.compare_digest(expected, sig.partition(",")[2])
+        for sig in signatures.split()
+    )
+
+
+@seam_bp.route('/webhook', methods=['POST'])
+def webhook():
+    """Queue access_code.* events for event_worker and return straight away."""
+    body = request.get_data()
+    if not verify(body, request.headers):
+        return jsonify({"error": "Invalid signature"}), 401
+
+    event = json.loads(body)
+    event_type = event.get("event_type", "")
+    if not event_type.startswith("access_code."):
+        return jsonify({"skipped": True}), 200
+
+    # Seam redelivers until it gets a 2xx, so the same event can arrive twice
+    SeamEvent.insert(
+        event_id=event.get("event_id") or request.headers["svix-id"],
+        event_type=event_type,
+        access_code_id=event.get("access_code_id"),
+        device_id=event.get("device_id"),
+        payload=event,
+    ).on_conflict_ignore().execute()
+    event_worker.trigger()
+    return jsonify({"queued": True}), 200
@@ -0,0 +1,157 @@
+import os
+from datetime import datetime, timedelta, timezone
+from peewee import AutoField, TextField, IntegerField, DateTimeField, fn
+from playhouse.sqlite_ext import JSONField
+import upstream
+from db import db, BaseModel, RoomStay
+from devices import Lock
+from devices.codes import mirror_code, forget_code
+from devices.executor import bucket_for
+from reservations.common_sync import CommonCode
+from room_block import RoomBlockCode
+from reservations.cache import invalidate_reservations
+from worker import Worker
+
+# Events per read; failed ones are retried on later runs, up to MAX_ATTEMPTS
+EVENT_BATCH_SIZE = 100
+MAX_ATTEMPTS = 5
+# Applied events are kept this long for debugging
+EVENT_RETENTION = timedelta(days=7)
+
+
+class SeamEvent(BaseModel):
+    """Verified access_code.* webhook events, applied by event_worker."""
+    id = AutoField()
+    event_id = TextField()
+    event_type = TextField()
+    access_code_id = TextField(null=True)
+    device_id = TextField(null=True)
+    payload = JSONField()
+    received_at = DateTimeField(default=lambda: datetime.now(timezone.utc))
+    processed_at = DateTimeField(null=True)
+    attempts = IntegerField(default=0)
+    last_error = TextField(null=True)
+
+
+def same_window(a, b):
+    """Whether two "starts_at|ends_at" strings name the same instants."""
+    def parse(window):
+        return tuple(datetime.fromisoformat(t) if t else None for t in (window or "|").split("|"))
+    return parse(a) == parse(b)
+
+
+def fetch_code(access_code_id, lock):
+    """Current state of the code from Seam, or None if it no longer exists."""
+    bucket_for(lock.api_key_env).acquire()
+    resp = upstream.seam.post(
+        "access_codes/get", key=os.environ.get(lock.api_key_env), idempotent=True,
+        json={"access_code_id": access_code_id}
+    )
+    if resp.status_code == 404:
+        return None
+    if not resp.ok:
+        raise RuntimeError(f"access_codes/get failed: {resp.status_code} {resp.text}")
+    return resp.json()["access_code"]
+
+
+def code_deleted(access_code_id):
+    """Drop every reference to a code that no longer exists in Seam.
+
+    Room and common rows lose their code so the next sync recreates it;
+    a room block's code is not recreated, so its record goes.
+    """
+    forget_code(access_code_id)
+    stays = RoomStay.update(seam_access_code_id=None, seam_window=None).where(
+        RoomStay.seam_access_code_id == access_code_id
+    ).execute()
+    common = CommonCode.update(seam_access_code_id=None, seam_window=None).where(
+        CommonCode.seam_access_code_id == access_code_id
+    ).execute()
+    blocks = RoomBlockCode.delete().where(RoomBlockCode.seam_code_id == access_code_id).execute()
+    if stays:
+        invalidate_reservations()
+    if stays or common or blocks:
+        print(f"Seam code {access_code_id} deleted: cleared {stays} stays, {common} common codes, {blocks} room blocks")
+
+
+def code_changed(code):
+    """Mirror the code, and flag rows whose window was changed in Seam.
+
+    Storing Seam's window makes sync's update phase see it differ from the
+    one it wants and push that back.
+    """
+    mirror_code(code)
+    window = f"{code.get('starts_at') or ''}|{code.get('ends_at') or ''}"
+    for model in (RoomStay, CommonCode):
+        for row in model.select().where(
+            (model.seam_access_code_id == code["access_code_id"]) & model.seam_window.is_null(False)
+        ):
+            if not same_window(row.seam_window, window):
+                model.update(seam_window=window).where(model.id == row.id).execute()
+                if model is RoomStay:
+                    invalidate_reservations()
+                print(f"Seam code {code['access_code_id']} window changed outside sync")
+
+
+def apply_events(progress=None):
+    """Apply queued events, once per access code however many arrived.
+
+    Deletions are applied directly; anything else refetches the code, so
+    out-of-order deliveries still end at Seam's current state.
+    """
+    last_id = SeamEvent.select(fn.MAX(SeamEvent.id)).scalar() or 0
+    cursor = 0
+    applied = failed = 0
+    while True:
+        events = list(
+            SeamEvent.select()
+            .where(SeamEvent.processed_at.is_null() & (SeamEvent.attempts < MAX_ATTEMPTS)
+                   & (SeamEvent.id > cursor) & (SeamEvent.id <= last_id))
+            .order_by(SeamEvent.id)
+            .limit(EVENT_BATCH_SIZE)
+        )
+        if not events:
+            break
+        cursor = events[-1].id
+
+        by_code = {}
+        for event in events:
+            by_code.setdefault(event.access_code_id, []).append(event)
+
+        for access_code_id, group in by_code.items():
+            ids = [e.id for e in group]
+            # Codes on devices without a Lock aren't ours to track
+            lock = Lock.select().where(Lock.device_id == group[-1].device_id).first()
+            try:
+                if access_code_id and lock:
+                    if any(e.event_type == "access_code.deleted" for e in group):
+                        code = None
+                    else:
+                        code = fetch_code(access_code_id, lock)
+                    with db.atomic():
+                        if code is None:
+                            code_deleted(access_code_id)
+                        else:
+                            code_changed(code)
+                SeamEvent.update(processed_at=datetime.now(timezone.utc), last_error=None).where(
+                    SeamEvent.id.in_(ids)
+                ).execute()
+                applied += len(ids)
+            except Exception as e:
+                SeamEvent.update(attempts=SeamEvent.attempts + 1, last_error=str(e)).where(
+                    SeamEvent.id.in_(ids)
+                ).execute()
+                failed += len(ids)
+                print(f"Failed to apply Seam events for {access_code_id}: {e}")
+        if progress:
+            progress(f"applied {applied} events")
+
+    SeamEvent.delete().where(
+        SeamEvent.processed_at < datetime.now(timezone.utc) - EVENT_RETENTION
+    ).execute()
+    if applied or failed:
+        print(f"Applied {applied} Seam events, {failed} failed")
+
+
+# Triggered by each webhook; the interval retries failed events
+event_worker = Worker("seam-events", apply_events, timedelta(minutes=1))
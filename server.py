@@ -1,36 +1,156 @@
+import hashlib
+import operator
 import os
-from flask import Flask
-from db import db, RoomStay, ChatMessage
+from datetime import datetime, timezone
+from functools import reduce
+from urllib.parse import urlencode
+from flask import Flask, Response, request, stream_with_context
+from markupsafe import escape
+from peewee import fn
+from db import db, init_app, RoomStay, ReservationPayload, ChatMessage, ChatMessageArchive, ConversationSummary
+from migrate import run_migrations
+import metrics
+from metrics import SyncRun
 from devices import Lock
+from devices.codes import DeviceCode, MirroredDevice
 from reservations.common_sync import CommonCode
-from reservations import reservations_bp
+from reservations import reservations_bp, sync_worker, reservation_worker
+from reservations.sync import SyncState
+from reservations.cache import reservations_generation
+from reservations.webhook import SyncRequest
 from ota import ota_bp
+from ota.index import OtaReservation
+from ota.outbox import OutboxTask, outbox_worker
 from guest import guest_bp
+from guest.archive import archive_worker
 from staff import staff_bp
-from room_block import room_block_bp, RoomBlockCode
+from room_block import room_block_bp, RoomBlockCode, reconcile_worker
+from seam_webhook import seam_bp
+from seam_webhook.events import SeamEvent, event_worker
 
 app = Flask(__name__)
+init_app(app)
 app.register_blueprint(reservations_bp)
 app.register_blueprint(ota_bp)
 app.register_blueprint(guest_bp)
 app.register_blueprint(staff_bp)
 app.register_blueprint(room_block_bp)
+app.register_blueprint(seam_bp)
+
+db.create_tables([
+    RoomStay, ReservationPayload, ChatMessage, ChatMessageArchive, ConversationSummary,
+    Lock, CommonCode, RoomBlockCode, SyncState, OtaReservation, DeviceCode, MirroredDevice, SeamEvent,
+    SyncRequest, OutboxTask, SyncRun,
+])
+run_migrations()
+
+# The generation counter restarts with the process, so ETags carry the start time
+STARTED = datetime.now(timezone.utc)
+
+# Rows per dashboard page
+DASHBOARD_PAGE_SIZE = 100
+DASHBOARD_COLUMNS = [
+    ("ID", RoomStay.id), ("Res ID", RoomStay.reservation_id), ("Room ID", RoomStay.room_id),
+    ("Room", RoomStay.room_name), ("Guest", RoomStay.guest_name), ("Room Status", RoomStay.room_status),
+    ("Room In", RoomStay.room_check_in), ("Room Out", RoomStay.room_check_out),
+    ("Res In", RoomStay.res_check_in), ("Res Out", RoomStay.res_check_out),
+    ("Res Status", RoomStay.res_status), ("Balance", RoomStay.balance),
+    ("Modified", RoomStay.date_modified), ("Seam Code", RoomStay.seam_access_code_id),
+]
+
+
+def dashboard_filter(args):
+    """Where clause from ?status=&from=&to=&room= (stays overlapping from..to)."""
+    where = []
+    if args.get("status"):
+        where.append(RoomStay.res_status == args["status"])
+    if args.get("from"):
+        where.append(RoomStay.room_check_out >= args["from"])
+    if args.get("to"):
+        where.append(RoomStay.room_check_in <= args["to"])
+    if args.get("room"):
+        where.append((RoomStay.room_name == args["room"]) | (RoomStay.room_id == args["room"]))
+    return reduce(operator.and_, where, True)
+
+
+def dashboard_etag(where):
+    """Changes whenever a matching row is added, removed or modified, or any
+    RoomStay write (including code-only changes) bumps the generation."""
+    latest, count = RoomStay.select(fn.MAX(RoomStay.date_modified), fn.COUNT(RoomStay.id)).where(where).scalar(as_tuple=True)
+    key = f"{latest}|{count}|{STARTED.isoformat()}|{reservations_generation()}|{request.query_string.decode()}"
+    return hashlib.sha1(key.encode()).hexdigest()
 
-db.create_tables([RoomStay, ChatMessage, Lock, CommonCode, RoomBlockCode])
 
 @app.route("/")
 def index():
-    rows = ""
-    for r in RoomStay.select():
-        rows += f"<tr><td>{r.id}</td><td>{r.reservation_id}</td><td>{r.room_id}</td><td>{r.room_name}</td><td>{r.guest_name}</td><td>{r.room_status}</td><td>{r.room_check_in}</td><td>{r.room_check_out}</td><td>{r.res_check_in}</td><td>{r.res_check_out}</td><td>{r.res_status}</td><td>${r.balance:.2f}</td><td>{r.date_modified}</td><td>{r.seam_access_code_id or ''}</td></tr>"
+    where = dashboard_filter(request.args)
+    etag = dashboard_etag(where)
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
 
-    return f"""<!DOCTYPE html>
+    # Keyset pagination on (room_check_in, id); ?after= is the last row's pair
+    query = RoomStay.select(*[col for _, col in DASHBOARD_COLUMNS]).where(where)
+    if request.args.get("after"):
+        check_in, _, stay_id = request.args["after"].partition("|")
+        query = query.where(
+            (RoomStay.room_check_in > check_in)
+            | ((RoomStay.room_check_in == check_in) & (RoomStay.id > stay_id))
+        )
+    stays = list(query.order_by(RoomStay.room_check_in, RoomStay.id).limit(DASHBOARD_PAGE_SIZE + 1))
+    more = len(stays) > DASHBOARD_PAGE_SIZE
+    stays = stays[:DASHBOARD_PAGE_SIZE]
+
+    def field(name):
+        return escape(request.args.get(name, ""))
+
+    def generate():
+        yield f"""<!DOCTYPE html>
 <html><head><title>Room Stays</title>
-<style>table{{border-collapse:collapse;width:100%}}th,td{{border:1px solid #ddd;padding:8px}}th{{background:#333;color:white}}</style>
+<style>table{{border-collapse:collapse;width:100%}}th,td{{border:1px solid #ddd;padding:8px}}th{{background:#333;color:white}}form{{margin:12px 0}}</style>
 </head><body><h1>Room Stays</h1>
 <a href="/sync"><button>Sync Now</button></a>
-<table><tr><th>ID</th><th>Res ID</th><th>Room ID</th><th>Room</th><th>Guest</th><th>Room Status</th><th>Room In</th><th>Room Out</th><th>Res In</th><th>Res Out</th><th>Res Status</th><th>Balance</th><th>Modified</th><th>Seam Code</th></tr>{rows}</table>
-</body></html>"""
+<form method="get">
+Status <input name="status" value="{field('status')}">
+From <input type="date" name="from" value="{field('from')}">
+To <input type="date" name="to" value="{field('to')}">
+Room <input name="room" value="{field('room')}">
+<button>Filter</button> <a href="/">Clear</a>
+</form>
+<table><tr>{"".join(f"<th>{title}</th>" for title, _ in DASHBOARD_COLUMNS)}</tr>
+"""
+        for r in stays:
+            yield (
+                f"<tr><td>{escape(r.id)}</td><td>{escape(r.reservation_id)}</td><td>{escape(r.room_id)}</td>"
+                f"<td>{escape(r.room_name)}</td><td>{escape(r.guest_name)}</td><td>{escape(r.room_status)}</td>"
+                f"<td>{r.room_check_in}</td><td>{r.room_check_out}</td><td>{r.res_check_in}</td>"
+                f"<td>{r.res_check_out}</td><td>{escape(r.res_status)}</td><td>${r.balance:.2f}</td>"
+                f"<td>{r.date_modified}</td><td>{escape(r.seam_access_code_id or '')}</td></tr>\n"
+            )
+        yield "</table>"
+        if more:
+            args = {k: v for k, v in request.args.items() if k != "after"}
+            args["after"] = f"{stays[-1].room_check_in}|{stays[-1].id}"
+            yield f'<p><a href="/?{escape(urlencode(args))}">Next page</a></p>'
+        yield "</body></html>"
+
+    return Response(stream_with_context(generate()), mimetype="text/html",
+                    headers={"ETag": f'"{etag}"', "Cache-Control": "no-cache"})
+
+
+@app.route("/metrics")
+def metrics_page():
+    """Prometheus scrape endpoint; behind basicauth like the dashboard."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 
 if __name__ == "__main__":
-    app.run(debug=os.environ.get("FLASK_DEBUG", False))
+    debug = os.environ.get("FLASK_DEBUG", False)
+    # With the debug reloader, only the child process serves requests
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN"):
+        sync_worker.start()
+        archive_worker.start()
+        event_worker.start()
+        reservation_worker.start()
+        reconcile_worker.start()
+        outbox_worker.start()
+    app.run(debug=debug)
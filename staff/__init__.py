@@ -1,101 +1,257 @@
 from flask import Blueprint, request, jsonify
-from db import RoomStay, ChatMessage
+from db import ConversationSummary
+from guest import save_message, publish_message
+from ota.outbox import OutboxTask, ATTENTION_STATUSES, attention_tasks, record_counts
+
+# Conversations per sidebar page, by default and at most
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
 
 staff_bp = Blueprint("staff", __name__, url_prefix="/staff")
 
 
+@staff_bp.route("/conversations")
+def conversations():
+    """Sidebar page, most recent activity first.
+
+    Pass the returned `next` back as ?before= for the following page.
+    """
+    limit = max(1, min(request.args.get("limit", PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    query = ConversationSummary.select().order_by(ConversationSummary.last_message_id.desc()).limit(limit)
+    before = request.args.get("before", type=int)
+    if before is not None:
+        query = query.where(ConversationSummary.last_message_id < before)
+    convs = list(query)
+    rows = [
+        {
+            "reservation_id": c.reservation_id,
+            "guest_name": c.guest_name,
+            "last_message": c.last_message,
+            "last_sender": c.last_sender,
+            "last_activity": str(c.last_activity),
+            "unread_count": c.unread_count,
+        }
+        for c in convs
+    ]
+    next_cursor = convs[-1].last_message_id if len(convs) == limit else None
+    return jsonify({"conversations": rows, "next": next_cursor})
+
+
+@staff_bp.route("/<reservation_id>/read", methods=["POST"])
+def mark_read(reservation_id):
+    ConversationSummary.update(unread_count=0).where(
+        ConversationSummary.reservation_id == reservation_id
+    ).execute()
+    return jsonify({"success": True})
+
+
+@staff_bp.route("/outbox")
+def outbox():
+    """OTA follow-ups that failed or may have applied; check Cloudbeds by hand."""
+    return jsonify([
+        {
+            "id": t.id,
+            "kind": t.kind,
+            "reservation_id": t.reservation_id,
+            "payload": t.payload,
+            "status": t.status,
+            "attempts": t.attempts,
+            "last_error": t.last_error,
+            "created_at": str(t.created_at),
+        }
+        for t in attention_tasks()
+    ])
+
+
+@staff_bp.route("/outbox/<int:task_id>/resolve", methods=["POST"])
+def resolve_outbox_task(task_id):
+    """Mark a failed or review task as handled."""
+    updated = OutboxTask.update(status="resolved").where(
+        (OutboxTask.id == task_id) & OutboxTask.status.in_(ATTENTION_STATUSES)
+    ).execute()
+    if not updated:
+        return jsonify({"error": "No such task needing attention"}), 404
+    record_counts()
+    return jsonify({"success": True})
+
+
 @staff_bp.route("/chat")
 def chat():
-    reservations = (
-        RoomStay.select(RoomStay.reservation_id, RoomStay.guest_name)
-        .distinct()
-        .order_by(RoomStay.reservation_id)
-    )
-    sidebar = ""
-    for r in reservations:
-        sidebar += f'<div class="res" onclick="select(\'{r.reservation_id}\')">{r.reservation_id}<br><small>{r.guest_name}</small></div>'
-
-    return f"""<!DOCTYPE html>
+    return """<!DOCTYPE html>
 <html><head><title>Staff Chat</title>
 <style>
-    * {{ margin:0; padding:0; box-sizing:border-box; }}
-    html, body {{ height:100%; font-family:-apple-system,system-ui,sans-serif; }}
-    body {{ display:flex; }}
-    #sidebar {{ width:260px; background:#2c2c2c; color:white; overflow-y:auto; flex-shrink:0; }}
-    #sidebar h2 {{ padding:16px; font-size:16px; border-bottom:1px solid #444; }}
-    .res {{ padding:12px 16px; border-bottom:1px solid #444; cursor:pointer; font-size:14px; }}
-    .res:hover, .res.active {{ background:#444; }}
-    .res small {{ opacity:0.7; }}
-    #chat {{ flex:1; display:flex; flex-direction:column; background:#f5f5f5; }}
-    #chat-header {{ padding:12px 16px; background:white; border-bottom:1px solid #ddd; font-weight:600; }}
-    #messages {{ flex:1; overflow-y:auto; padding:16px; display:flex; flex-direction:column; gap:6px; }}
-    .msg {{ max-width:70%; padding:10px 14px; border-radius:18px; font-size:15px; line-height:1.4; word-wrap:break-word; }}
-    .msg.guest {{ background:#e4e6eb; align-self:flex-start; border-bottom-left-radius:4px; }}
-    .msg.staff {{ background:#0084ff; color:white; align-self:flex-end; border-bottom-right-radius:4px; }}
-    .msg .time {{ font-size:11px; opacity:0.6; margin-top:4px; }}
-    #input-bar {{ display:flex; padding:8px 12px; background:white; border-top:1px solid #ddd; gap:8px; }}
-    #input-bar input {{ flex:1; padding:10px 16px; border:1px solid #ddd; border-radius:20px; outline:none; font-size:15px; }}
-    #input-bar button {{ padding:10px 18px; background:#0084ff; color:white; border:none; border-radius:20px; cursor:pointer; font-size:15px; }}
-    #placeholder {{ flex:1; display:flex; align-items:center; justify-content:center; color:#999; font-size:18px; }}
+    * { margin:0; padding:0; box-sizing:border-box; }
+    html, body { height:100%; font-family:-apple-system,system-ui,sans-serif; }
+    body { display:flex; }
+    #sidebar { width:260px; background:#2c2c2c; color:white; overflow-y:auto; flex-shrink:0; }
+    #sidebar h2 { padding:16px; font-size:16px; border-bottom:1px solid #444; }
+    .res { padding:12px 16px; border-bottom:1px solid #444; cursor:pointer; font-size:14px; }
+    .res:hover, .res.active { background:#444; }
+    .res small { opacity:0.7; }
+    .res .preview { display:block; opacity:0.5; white-space:nowrap; overflow:hidden; text-overflow:ellipsis; }
+    .unread { float:right; background:#0084ff; border-radius:10px; padding:0 7px; font-size:12px; }
+    #open-res { width:calc(100% - 24px); margin:12px; padding:6px 10px; border-radius:6px; border:none; }
+    #more { display:none; width:100%; padding:10px; background:none; color:#aaa; border:none; cursor:pointer; }
+    #chat { flex:1; display:flex; flex-direction:column; background:#f5f5f5; }
+    #chat-header { padding:12px 16px; background:white; border-bottom:1px solid #ddd; font-weight:600; }
+    #messages { flex:1; overflow-y:auto; padding:16px; display:flex; flex-direction:column; gap:6px; }
+    .msg { max-width:70%; padding:10px 14px; border-radius:18px; font-size:15px; line-height:1.4; word-wrap:break-word; }
+    .msg.guest { background:#e4e6eb; align-self:flex-start; border-bottom-left-radius:4px; }
+    .msg.staff { background:#0084ff; color:white; align-self:flex-end; border-bottom-right-radius:4px; }
+    .msg .time { font-size:11px; opacity:0.6; margin-top:4px; }
+    #older { display:none; align-self:center; padding:6px 14px; background:none; color:#0084ff; border:none; cursor:pointer; font-size:14px; }
+    #input-bar { display:flex; padding:8px 12px; background:white; border-top:1px solid #ddd; gap:8px; }
+    #input-bar input { flex:1; padding:10px 16px; border:1px solid #ddd; border-radius:20px; outline:none; font-size:15px; }
+    #input-bar button { padding:10px 18px; background:#0084ff; color:white; border:none; border-radius:20px; cursor:pointer; font-size:15px; }
+    #placeholder { flex:1; display:flex; align-items:center; justify-content:center; color:#999; font-size:18px; }
 </style>
 </head><body>
-<div id="sidebar"><h2>Reservations</h2>{sidebar}</div>
+<div id="sidebar">
+    <h2>Conversations</h2>
+    <input id="open-res" placeholder="Open reservation ID..." autocomplete="off">
+    <div id="list"></div>
+    <button id="more" onclick="loadPage(nextCursor)">Load more</button>
+</div>
 <div id="chat">
     <div id="placeholder">Select a reservation</div>
 </div>
 <script>
     let currentRes = null;
-    let poll = null;
+    let events = null;
+    let nextCursor = null;
+    let pagedPastFirst = false;
+    let readTimer = null;
+    let oldestId = null;
+    // Messages per history page, as HISTORY_LIMIT in guest
+    const pageSize = 50;
+
+    function renderRow(c) {
+        const el = document.createElement('div');
+        el.className = 'res' + (c.reservation_id === currentRes ? ' active' : '');
+        el.dataset.res = c.reservation_id;
+        el.onclick = () => select(c.reservation_id);
+        if (c.unread_count) {
+            const badge = document.createElement('span');
+            badge.className = 'unread';
+            badge.textContent = c.unread_count;
+            el.appendChild(badge);
+        }
+        el.appendChild(document.createTextNode(c.reservation_id));
+        el.appendChild(document.createElement('br'));
+        const name = document.createElement('small');
+        name.textContent = c.guest_name || '';
+        el.appendChild(name);
+        const preview = document.createElement('small');
+        preview.className = 'preview';
+        preview.textContent = c.last_sender + ': ' + c.last_message;
+        el.appendChild(preview);
+        return el;
+    }
+
+    // Sidebar comes from /staff/conversations a page at a time; without a
+    // cursor it reloads the first page
+    function loadPage(before) {
+        const url = '/staff/conversations' + (before ? `?before=${before}` : '');
+        fetch(url).then(r => r.json()).then(page => {
+            const list = document.getElementById('list');
+            if (before) pagedPastFirst = true;
+            else list.innerHTML = '';
+            page.conversations.forEach(c => list.appendChild(renderRow(c)));
+            nextCursor = page.next;
+            document.getElementById('more').style.display = nextCursor ? 'block' : 'none';
+        });
+    }
 
-    function select(resId) {{
+    function markRead(resId) {
+        fetch(`/staff/${resId}/read`, {method: 'POST'});
+        const badge = document.querySelector(`.res[data-res="${CSS.escape(resId)}"] .unread`);
+        if (badge) badge.remove();
+    }
+
+    function select(resId) {
         currentRes = resId;
-        document.querySelectorAll('.res').forEach(el => el.classList.remove('active'));
-        event.currentTarget.classList.add('active');
+        document.querySelectorAll('.res').forEach(el => el.classList.toggle('active', el.dataset.res === resId));
+        markRead(resId);
 
         document.getElementById('chat').innerHTML = `
-            <div id="chat-header">Reservation: ${{resId}}</div>
-            <div id="messages"></div>
+            <div id="chat-header">Reservation: ${resId}</div>
+            <div id="messages"><button id="older" onclick="loadOlder()">Load older messages</button></div>
             <div id="input-bar">
                 <input type="text" id="msg" placeholder="Type a reply..." autocomplete="off">
                 <button onclick="send()">Send</button>
             </div>
         `;
-        document.getElementById('msg').addEventListener('keydown', e => {{ if (e.key === 'Enter') send(); }});
+        document.getElementById('msg').addEventListener('keydown', e => { if (e.key === 'Enter') send(); });
+        oldestId = null;
+
+        // History on connect, then new messages as they're posted
+        if (events) events.close();
+        events = new EventSource(`/guest/${resId}/events`);
+        events.onmessage = e => {
+            const m = JSON.parse(e.data);
+            addMessage(m);
+            // Debounced so the history replay on connect posts once
+            if (m.sender === 'guest') {
+                clearTimeout(readTimer);
+                readTimer = setTimeout(() => markRead(resId), 1000);
+            }
+        };
+    }
+
+    function messageEl(m) {
+        const el = document.createElement('div');
+        el.className = 'msg ' + m.sender;
+        el.innerHTML = m.message + `<div class="time">${m.sender}</div>`;
+        return el;
+    }
 
-        if (poll) clearInterval(poll);
-        loadMessages();
-        poll = setInterval(loadMessages, 3000);
-    }}
+    function addMessage(m) {
+        const div = document.getElementById('messages');
+        const atBottom = div.scrollHeight - div.scrollTop - div.clientHeight < 50;
+        div.appendChild(messageEl(m));
+        if (oldestId === null) {
+            oldestId = m.id;
+            document.getElementById('older').style.display = 'block';
+        }
+        if (atBottom || m.sender === 'staff') div.scrollTop = div.scrollHeight;
+    }
 
-    function loadMessages() {{
-        return fetch(`/guest/${{currentRes}}/messages`)
+    // The replay on connect is only the latest page; earlier messages,
+    // archived ones included, are fetched a page at a time
+    function loadOlder() {
+        const resId = currentRes;
+        fetch(`/guest/${resId}/messages?before=${oldestId}&limit=${pageSize}`)
             .then(r => r.json())
-            .then(msgs => {{
+            .then(msgs => {
+                if (resId !== currentRes) return;
                 const div = document.getElementById('messages');
-                const atBottom = div.scrollHeight - div.scrollTop - div.clientHeight < 50;
-                div.innerHTML = '';
-                msgs.forEach(m => {{
-                    const el = document.createElement('div');
-                    el.className = 'msg ' + m.sender;
-                    el.innerHTML = m.message + `<div class="time">${{m.sender}}</div>`;
-                    div.appendChild(el);
-                }});
-                if (atBottom) div.scrollTop = div.scrollHeight;
-            }});
-    }}
-
-    function send() {{
+                const button = document.getElementById('older');
+                const fromBottom = div.scrollHeight - div.scrollTop;
+                button.after(...msgs.map(messageEl));
+                if (msgs.length) oldestId = msgs[0].id;
+                if (msgs.length < pageSize) button.style.display = 'none';
+                div.scrollTop = div.scrollHeight - fromBottom;
+            });
+    }
+
+    function send() {
         const text = document.getElementById('msg').value.trim();
         if (!text) return;
-        fetch(`/staff/${{currentRes}}/messages`, {{
+        fetch(`/staff/${currentRes}/messages`, {
             method: 'POST',
-            headers: {{'Content-Type': 'application/json'}},
-            body: JSON.stringify({{message: text}})
-        }}).then(() => {{
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({message: text})
+        }).then(() => {
             document.getElementById('msg').value = '';
-            loadMessages().then(() => {{ document.getElementById('messages').scrollTop = document.getElementById('messages').scrollHeight; }});
-        }});
-    }}
+        });
+    }
+
+    document.getElementById('open-res').addEventListener('keydown', e => {
+        if (e.key === 'Enter' && e.target.value.trim()) select(e.target.value.trim());
+    });
+    loadPage();
+    // Refresh ordering and unread counts, unless staff have paged further down
+    setInterval(() => { if (!pagedPastFirst) loadPage(); }, 30000);
 </script>
 </body></html>"""
 
@@ -103,9 +259,6 @@ def chat():
 @staff_bp.route("/<reservation_id>/messages", methods=["POST"])
 def post_message(reservation_id):
     data = request.get_json()
-    ChatMessage.create(
-        reservation_id=reservation_id,
-        sender="staff",
-        message=data.get("message", "").strip()
-    )
+    msg = save_message(reservation_id, "staff", data.get("message", "").strip())
+    publish_message(msg)
     return jsonify({"success": True})
@@ -0,0 +1,114 @@
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+import metrics
+
+load_dotenv()
+
+# (connect, read) seconds; no call may hang a worker indefinitely
+TIMEOUT = (5, 30)
+RETRIES = 3
+BACKOFF = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class Client:
+    """Pooled keep-alive session for one upstream API.
+
+    Every call has a timeout. 429s are retried with jittered exponential
+    backoff (honouring Retry-After); 5xx responses and connection errors are
+    only retried for idempotent calls, so a create is never sent twice.
+    Latency and outcome are counted per endpoint, see stats(), and exported
+    to /metrics.
+    """
+
+    def __init__(self, name, base_url, token=None, pool_size=16):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def request(self, method, endpoint, key=None, idempotent=None, timeout=TIMEOUT, **kwargs):
+        if idempotent is None:
+            idempotent = method in ("GET", "PUT", "DELETE")
+        key = key or (self.token() if self.token else None)
+        headers = {"Authorization": f"Bearer {key}"} if key else {}
+        url = f"{self.base_url}/{endpoint}"
+
+        for attempt in range(RETRIES + 1):
+            started = time.perf_counter()
+            try:
+                resp = self.session.request(method, url, headers=headers, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record(endpoint, None, time.perf_counter() - started)
+                if not idempotent or attempt == RETRIES:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+            self._record(endpoint, resp.status_code, time.perf_counter() - started)
+
+            retryable = resp.status_code == 429 or (idempotent and resp.status_code >= 500)
+            if not retryable or resp.status_code not in RETRY_STATUSES or attempt == RETRIES:
+                return resp
+            time.sleep(self._backoff(attempt, resp.headers.get("Retry-After")))
+        return resp
+
+    def get(self, endpoint, **kwargs):
+        return self.request("GET", endpoint, **kwargs)
+
+    def post(self, endpoint, **kwargs):
+        return self.request("POST", endpoint, **kwargs)
+
+    def put(self, endpoint, **kwargs):
+        return self.request("PUT", endpoint, **kwargs)
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    def _record(self, endpoint, status, seconds):
+        with self.lock:
+            c = self.counters.setdefault(endpoint, {
+                "calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0, "statuses": {},
+            })
+            c["calls"] += 1
+            c["seconds"] += seconds
+            c["max_seconds"] = max(c["max_seconds"], seconds)
+            if status is None or status >= 400:
+                c["errors"] += 1
+            status_key = str(status) if status else "error"
+            c["statuses"][status_key] = c["statuses"].get(status_key, 0) + 1
+        labels = {"api": self.name, "endpoint": endpoint, "status": str(status) if status else "error"}
+        metrics.inc("upstream_requests_total", labels)
+        metrics.observe("upstream_request_seconds", labels, seconds)
+
+    def stats(self):
+        with self.lock:
+            return {
+                endpoint: {**c, "avg_seconds": c["seconds"] / c["calls"], "statuses": dict(c["statuses"])}
+                for endpoint, c in self.counters.items()
+            }
+
+
+cloudbeds = Client(
+    "cloudbeds",
+    os.environ.get("CLOUDBEDS_BASE_URL", "https://api.cloudbeds.com/api/v1.2"),
+    token=lambda: os.environ.get("CLOUDBEDS_API_KEY"),
+)
+
+# Seam keys are per lock (Lock.api_key_env), so callers pass key=...
+seam = Client("seam", os.environ.get("SEAM_BASE_URL", "https://connect.getseam.com"))
+
+
+def stats():
+    return {client.name: client.stats() for client in (cloudbeds, seam)}
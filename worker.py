@@ -0,0 +1,130 @@
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+
+class Worker:
+    """Runs `target` on a background thread, one run at a time.
+
+    trigger() wakes the thread and returns the run number. A trigger that
+    arrives while a run is in flight attaches to that run instead of
+    starting a second one; if it asked for different arguments (e.g.
+    full=True) a single follow-up run is queued. With `interval` set, the
+    target also runs on that schedule. `target` is called with a
+    `progress` callback plus the trigger's keyword arguments.
+
+    With `debounce` set, a triggered run waits until no trigger has arrived
+    for that long (but no longer than `max_delay`), so a burst becomes one
+    run; triggers during a run then queue a follow-up instead of attaching.
+    status() counts triggers and how many the last run absorbed, and
+    wait(run) blocks until the run a trigger returned has finished.
+    """
+
+    def __init__(self, name, target, interval=None, debounce=None, max_delay=None):
+        self.name = name
+        self.target = target
+        self.interval = interval
+        self.debounce = debounce
+        self.max_delay = max_delay or (debounce * 6 if debounce else None)
+        self.batched = 0
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+        self.wake = threading.Event()
+        self.thread = None
+        self.pending = None
+        self.state = {
+            "name": name,
+            "running": False,
+            "run": 0,
+            "args": {},
+            "progress": None,
+            "started_at": None,
+            "finished_at": None,
+            "duration": None,
+            "last_error": None,
+            "next_run_at": None,
+            "triggers": 0,
+            "last_merged": 0,
+        }
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+            self.thread.start()
+
+    def trigger(self, **kwargs):
+        with self.lock:
+            self.state["triggers"] += 1
+            if self.state["running"] and kwargs == self.state["args"] and not self.debounce:
+                self.state["last_merged"] += 1
+                return self.state["run"]
+            self.batched += 1
+            self.pending = {**(self.pending or {}), **kwargs}
+            self.wake.set()
+            return self.state["run"] + (2 if self.state["running"] else 1)
+
+    def report(self, progress):
+        with self.lock:
+            self.state["progress"] = progress
+
+    def status(self):
+        with self.lock:
+            return dict(self.state)
+
+    def wait(self, run, timeout=None):
+        """Block until run number `run` has finished; False on timeout."""
+        with self.finished:
+            return self.finished.wait_for(
+                lambda: self.state["run"] > run or (self.state["run"] == run and not self.state["running"]),
+                timeout,
+            )
+
+    def _settle(self):
+        """Wait out a burst: until `debounce` passes with no new trigger."""
+        deadline = time.monotonic() + self.max_delay.total_seconds()
+        while True:
+            self.wake.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.wake.wait(min(self.debounce.total_seconds(), remaining)):
+                return
+
+    def _loop(self):
+        while True:
+            timeout = self.interval.total_seconds() if self.interval else None
+            with self.lock:
+                self.state["next_run_at"] = (
+                    (datetime.now() + self.interval).isoformat() if self.interval else None
+                )
+            woke = self.wake.wait(timeout)
+            if woke and self.debounce:
+                self._settle()
+            started = datetime.now()
+            with self.lock:
+                self.wake.clear()
+                if woke and self.pending is None:
+                    continue
+                kwargs, self.pending = self.pending or {}, None
+                merged, self.batched = self.batched, 0
+                self.state.update(
+                    running=True, run=self.state["run"] + 1, args=kwargs, last_merged=merged,
+                    progress=None, started_at=started.isoformat(), next_run_at=None,
+                )
+
+            error = None
+            try:
+                self.target(progress=self.report, **kwargs)
+            except Exception:
+                error = traceback.format_exc()
+                print(f"{self.name} run failed:\n{error}")
+
+            finished = datetime.now()
+            with self.lock:
+                self.state.update(
+                    running=False, progress=None, last_error=error,
+                    finished_at=finished.isoformat(),
+                    duration=(finished - started) / timedelta(seconds=1),
+                )
+                self.finished.notify_all()